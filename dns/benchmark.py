@@ -0,0 +1,254 @@
+import argparse
+import bisect
+import itertools
+import random
+import socket
+import sys
+import time
+import timeit
+import tracemalloc
+from threading import Thread
+
+from dns_async_server import AsyncDnsCacheServer
+from dns_cache import DnsCache, CACHE_SHARDS
+from dns_models import DnsHeader, DnsPackage, DnsQuery, DnsResourceRecord, dns_query_package, HEADER
+from dns_parser import bytes2package, bytes2request
+from dns_ratelimit import RateLimiter
+from dns_server import DnsCacheServer
+from fake_upstream import FakeUpstream
+
+ENGINES = {'thread': DnsCacheServer, 'asyncio': AsyncDnsCacheServer}
+QTYPES = {'a': 1, 'ns': 2, 'cname': 5, 'mx': 15, 'txt': 16, 'aaaa': 28}
+LOAD_PORT = 5399
+RECEIVE_TIMEOUT = 0.2
+
+
+def _cache_worker(cache: DnsCache, names: list[str], operations: int, put_share: float, seed: int):
+    rnd = random.Random(seed)
+    for _ in range(operations):
+        name = names[rnd.randrange(len(names))]
+        if rnd.random() < put_share:
+            cache.put(name, 1, 1, 3600, b'\x7f\x00\x00\x01')
+        else:
+            cache.get(name, 1, 1)
+
+
+def contention_benchmark(threads: int, shards: int, keys: int, operations: int, put_share: float) -> float:
+    cache = DnsCache(shards=shards)
+    names = [f'host{i}.example.com' for i in range(keys)]
+    for name in names:
+        cache.put(name, 1, 1, 3600, b'\x7f\x00\x00\x01')
+
+    workers = [Thread(target=_cache_worker, args=(cache, names, operations, put_share, seed))
+               for seed in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * operations / (time.perf_counter() - started)
+
+
+def run_contention(args):
+    print(f'{"потоков":>8} {"шардов":>8} {"операций/с":>12}')
+    for shards in args.shards:
+        for threads in args.threads:
+            ops = contention_benchmark(threads, shards, args.keys, args.operations, args.put_share)
+            print(f'{threads:>8} {shards:>8} {ops:>12.0f}')
+
+
+def zipf_cum_weights(count: int, exponent: float) -> list[float]:
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def parse_qtype_mix(mix: str) -> (list[int], list[float]):
+    qtypes, weights = [], []
+    for part in mix.split(','):
+        name, _, weight = part.partition(':')
+        qtypes.append(QTYPES[name.strip().lower()])
+        weights.append(float(weight or 1))
+    return qtypes, list(itertools.accumulate(weights))
+
+
+def query_mix(names: int, exponent: float, qtype_mix: str, miss_ratio: float, seed: int):
+    # popular names follow Zipf's law like real resolver traffic, misses ask names never seen before
+    rnd = random.Random(seed)
+    name_weights = zipf_cum_weights(names, exponent)
+    qtypes, qtype_weights = parse_qtype_mix(qtype_mix)
+    for i in itertools.count():
+        qtype = qtypes[bisect.bisect(qtype_weights, rnd.random() * qtype_weights[-1])]
+        if rnd.random() < miss_ratio:
+            yield f'miss{i}-{seed}.example.com', qtype
+        else:
+            rank = bisect.bisect(name_weights, rnd.random() * name_weights[-1])
+            yield f'host{rank}.example.com', qtype
+
+
+def _receive_answers(sock: socket.socket, sent: dict[int, float], latencies: list[float], stop):
+    while not stop():
+        try:
+            response_bytes = sock.recv(65535)
+        except socket.timeout:
+            continue
+        except OSError:
+            break
+        received = time.perf_counter()
+        sent_at = sent.pop(HEADER.unpack_from(response_bytes)[0], None)
+        if sent_at is not None:
+            latencies.append(received - sent_at)
+
+
+def load_benchmark(address: tuple[str, int], queries, qps: int, duration: float, timeout: float):
+    # open loop: requests leave on schedule whether or not answers came back, so a slow server shows up
+    # as growing latency and loss instead of silently lowering the offered load
+    sent: dict[int, float] = {}
+    latencies: list[float] = []
+    finished = False
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.settimeout(RECEIVE_TIMEOUT)
+        receiver = Thread(target=_receive_answers, args=(sock, sent, latencies, lambda: finished), daemon=True)
+        receiver.start()
+
+        total = int(qps * duration)
+        started = time.perf_counter()
+        for i, (qname, qtype) in zip(range(total), queries):
+            delay = started + i / qps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            request_id = i & 0xFFFF
+            sent[request_id] = time.perf_counter()
+            sock.send(dns_query_package(request_id, [DnsQuery(qname, qtype, 1)]).to_bytes())
+        elapsed = time.perf_counter() - started
+
+        deadline = time.perf_counter() + timeout
+        while len(sent) > 0 and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        finished = True
+        receiver.join()
+    return total, elapsed, sorted(latencies)
+
+
+def percentile(values: list[float], share: float) -> float:
+    if len(values) == 0:
+        return float('nan')
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def run_load(args):
+    upstream = FakeUpstream(delay=args.upstream_delay, loss=args.upstream_loss).start()
+    server = ENGINES[args.engine]('127.0.0.1', args.port, DnsCache(), f'127.0.0.1:{upstream.address[1]}')
+    server.launch()
+    time.sleep(0.2)
+    try:
+        queries = query_mix(args.names, args.zipf, args.qtypes, args.miss_ratio, args.seed)
+        if args.warmup > 0:
+            load_benchmark(('127.0.0.1', args.port), queries, args.qps, args.warmup, args.timeout)
+        hits, misses = server.metrics.counters['cache_hits'], server.metrics.counters['cache_misses']
+        total, elapsed, latencies = load_benchmark(('127.0.0.1', args.port), queries, args.qps, args.duration,
+                                                   args.timeout)
+        hits = server.metrics.counters['cache_hits'] - hits
+        misses = server.metrics.counters['cache_misses'] - misses
+    finally:
+        server.stop()
+        upstream.stop()
+
+    print(f'{"отправлено":>12} {"получено":>10} {"потеряно":>10} {"ответов/с":>10} '
+          f'{"p50, мс":>9} {"p99, мс":>9} {"p999, мс":>9} {"попадания":>10}')
+    print(f'{total:>12} {len(latencies):>10} {total - len(latencies):>10} {len(latencies) / elapsed:>10.0f} '
+          f'{percentile(latencies, 0.5) * 1000:>9.3f} {percentile(latencies, 0.99) * 1000:>9.3f} '
+          f'{percentile(latencies, 0.999) * 1000:>9.3f} {hits / max(hits + misses, 1):>10.1%}')
+
+
+def sample_response(records: int) -> bytes:
+    header = DnsHeader(random.getrandbits(16), aa=False)
+    query = DnsQuery('www.example.com', 1, 1)
+    answers = [DnsResourceRecord('www.example.com', 1, 1, 300, 4, bytes([10, 0, 0, i % 256])) for i in range(records)]
+    return DnsPackage(header).with_queries([query]).with_ans_records(answers).to_bytes()
+
+
+def run_micro(args):
+    response_bytes = sample_response(args.records)
+    request_bytes = dns_query_package(1, [DnsQuery('www.example.com', 1, 1)]).to_bytes()
+    package = bytes2package(response_bytes)
+    cache = DnsCache()
+    for i in range(args.keys):
+        cache.put(f'host{i}.example.com', 1, 1, 3600, b'\x7f\x00\x00\x01')
+    names = itertools.cycle([f'host{i}.example.com' for i in range(args.keys)])
+    limiter = RateLimiter(1_000_000)
+    clients = itertools.cycle([f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(args.keys)])
+
+    cases = {
+        'bytes2request': lambda: bytes2request(request_bytes),
+        'bytes2package': lambda: bytes2package(response_bytes),
+        'DnsPackage.to_bytes': package.to_bytes,
+        'DnsCache.get': lambda: cache.get(next(names), 1, 1),
+        'RateLimiter.allow': lambda: limiter.allow(next(clients)),
+    }
+    print(f'{"операция":<22} {"мкс/оп":>10} {"операций/с":>12}')
+    for name, case in cases.items():
+        # the best of several repeats is the least disturbed by the rest of the system
+        seconds = min(timeit.repeat(case, number=args.number, repeat=args.repeat)) / args.number
+        print(f'{name:<22} {seconds * 1_000_000:>10.2f} {1 / seconds:>12.0f}')
+
+
+def run_memory(args):
+    # tracemalloc counts every allocation of the cache, including the interned names it keeps alive
+    tracemalloc.start()
+    cache = DnsCache()
+    for i in range(args.records // args.per_key):
+        name = sys.intern(f'host{i}.example.com')
+        for j in range(args.per_key):
+            cache.put(name, 1, 1, 3600, (i * args.per_key + j).to_bytes(4, 'big'))
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{"записей":>10} {"на ключ":>8} {"байт/запись":>12} {"МиБ на миллион":>15}')
+    print(f'{args.records:>10} {args.per_key:>8} {used / args.records:>12.0f} {used / args.records * 1e6 / 2 ** 20:>15.0f}')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    contention = modes.add_parser('contention', help='Пропускная способность DnsCache при разном числе потоков')
+    contention.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 4, 16])
+    contention.add_argument('-s', '--shards', type=int, nargs='+', default=[1, CACHE_SHARDS])
+    contention.add_argument('-k', '--keys', type=int, default=10000)
+    contention.add_argument('-n', '--operations', type=int, default=50000, help='Операций на поток')
+    contention.add_argument('--put-share', type=float, default=0.1, help='Доля операций записи')
+    contention.set_defaults(run=run_contention)
+
+    load = modes.add_parser('load', help='Нагрузочный тест сервера с тестовым вышестоящим сервером')
+    load.add_argument('-e', '--engine', choices=ENGINES.keys(), default='thread')
+    load.add_argument('--port', type=int, default=LOAD_PORT)
+    load.add_argument('-q', '--qps', type=int, default=2000, help='Целевое число запросов в секунду')
+    load.add_argument('-d', '--duration', type=float, default=10, help='Длительность замера в секундах')
+    load.add_argument('--warmup', type=float, default=2, help='Длительность прогрева кеша в секундах')
+    load.add_argument('--names', type=int, default=10000, help='Количество различных имён')
+    load.add_argument('--zipf', type=float, default=1.0, help='Показатель распределения Ципфа для имён')
+    load.add_argument('--qtypes', type=str, default='a:70,aaaa:25,mx:5', help='Доли типов запросов')
+    load.add_argument('--miss-ratio', type=float, default=0.05, help='Доля запросов к ещё не виденным именам')
+    load.add_argument('--upstream-delay', type=float, default=0.02, help='Задержка вышестоящего сервера в секундах')
+    load.add_argument('--upstream-loss', type=float, default=0.0, help='Доля потерь вышестоящего сервера')
+    load.add_argument('--timeout', type=float, default=2, help='Сколько ждать ответы после отправки последнего запроса')
+    load.add_argument('--seed', type=int, default=1)
+    load.set_defaults(run=run_load)
+
+    micro = modes.add_parser('micro', help='Микробенчмарки разбора, кодирования и кеша')
+    micro.add_argument('-n', '--number', type=int, default=20000, help='Вызовов в одном повторе')
+    micro.add_argument('-r', '--repeat', type=int, default=5)
+    micro.add_argument('--records', type=int, default=20, help='Записей в разбираемом ответе')
+    micro.add_argument('-k', '--keys', type=int, default=10000)
+    micro.set_defaults(run=run_micro)
+
+    memory = modes.add_parser('memory', help='Память, занимаемая кешем на одну запись')
+    memory.add_argument('-n', '--records', type=int, default=200000)
+    memory.add_argument('--per-key', type=int, default=1, help='Записей на одно имя')
+    memory.set_defaults(run=run_memory)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    args.run(args)
@@ -0,0 +1,316 @@
+import asyncio
+import random
+import time
+
+from dns_cache import DnsCache
+from dns_models import DnsPackage, dns_package_with_internal_error, with_response_id, is_truncated
+from dns_models import NXDOMAIN_TYPE, EDNS_PAYLOAD_SIZE
+from dns_parser import bytes2request
+from dns_server import DnsCacheServer, DnsCacheServerException, FORWARDER_TIMEOUT, MAX_HEDGED_UPSTREAMS
+from dns_tcp import AsyncTcpUpstreamConnection, TcpUpstreamPool, TCP_IDLE_TIMEOUT, frame, read_message
+from dns_upstream import Upstream
+
+WARM_UP_POLL_INTERVAL = 0.05
+
+
+class _ListenerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: 'AsyncDnsCacheServer'):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]):
+        self.server.answer_datagram(data, address)
+
+
+class _ForwarderProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        # upstream id -> (future, upstream address)
+        self.waiters: dict[int, (asyncio.Future, tuple[str, int])] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]):
+        if len(data) < 12:
+            return
+        upstream_id = int.from_bytes(data[:2], 'big')
+        if upstream_id not in self.waiters:
+            return
+        waiter, expected_address = self.waiters[upstream_id]
+        if address == expected_address and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc: Exception):
+        for waiter, _ in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+    def free_id(self) -> int:
+        if len(self.waiters) >= 0x10000:
+            raise DnsCacheServerException('Too many forwarder requests in flight')
+        while True:
+            upstream_id = random.getrandbits(16)
+            if upstream_id not in self.waiters:
+                return upstream_id
+
+    async def query(self, request_bytes: bytes, address: tuple[str, int], timeout: float) -> bytes:
+        upstream_id = self.free_id()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[upstream_id] = (waiter, address)
+        try:
+            self.transport.sendto(upstream_id.to_bytes(2, 'big') + request_bytes[2:], address)
+            response_bytes = await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.waiters.pop(upstream_id, None)
+        return request_bytes[:2] + response_bytes[2:]
+
+
+class AsyncDnsCacheServer(DnsCacheServer):
+    def __init__(self, host: str, port: int, cache: DnsCache, fw_host: str | list[str], fw_port: int = 53,
+                 udp_payload_size: int = EDNS_PAYLOAD_SIZE):
+        super().__init__(host, port, cache, fw_host, fw_port, udp_payload_size)
+        self.tcp_upstreams = TcpUpstreamPool(AsyncTcpUpstreamConnection)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.transport: asyncio.DatagramTransport | None = None
+        self.forwarder: _ForwarderProtocol | None = None
+        self.stopped: asyncio.Event | None = None
+        self.tasks: set[asyncio.Task] = set()
+        # (rd, edns, questions) -> forwarder task shared by identical requests
+        self.inflight: dict[tuple, asyncio.Task] = {}
+        self.metrics.gauge('inflight_forwards', lambda: len(self.inflight))
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        self.active = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        self.dns_demon.join()
+        self.log.stop()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.server_sock.setblocking(False)
+        await self.loop.create_datagram_endpoint(lambda: _ListenerProtocol(self), sock=self.server_sock)
+        _, self.forwarder = await self.loop.create_datagram_endpoint(_ForwarderProtocol, local_addr=('0.0.0.0', 0))
+        tcp_server = await asyncio.start_server(self.serve_tcp_async, sock=self.tcp_sock)
+        print('DNS сервер успешно запущен (asyncio)')
+
+        await self.stopped.wait()
+        tcp_server.close()
+        self.transport.close()
+        self.forwarder.transport.close()
+        self.tcp_upstreams.close()
+
+    def answer_datagram(self, request_bytes: bytes, address: tuple[str, int]):
+        if self.limiter is not None and not self.limiter.allow(address[0]):
+            response_bytes = self.shed(request_bytes)
+            if response_bytes != b'':
+                self.transport.sendto(response_bytes, address)
+            return
+        dns_response = self.fast_answer(request_bytes, address, False)
+        if dns_response is not None:
+            self.transport.sendto(dns_response, address)
+            return
+
+        started = time.perf_counter()
+        try:
+            request = bytes2request(request_bytes)
+        except Exception:
+            return
+        parsed = time.perf_counter()
+        self.log_request(request, address)
+
+        dns_response = self.from_cache(request)
+        cached = time.perf_counter()
+        if dns_response != b'':
+            dns_response = self.fit_udp(request, dns_response)
+            self.metrics.query(parsed - started, cached - parsed, None, dns_response, False)
+            self.send(dns_response, address, request.header.id)
+            return
+
+        self.start_task(self.answer_from_forwarder(request, request_bytes, address, parsed - started, cached - parsed))
+
+    async def serve_tcp_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info('peername')
+        try:
+            while self.active:
+                request_bytes = await asyncio.wait_for(read_message(reader), TCP_IDLE_TIMEOUT)
+                # every request of the connection is answered on its own, so slow ones do not block the rest
+                self.start_task(self.answer_stream(request_bytes, address, writer))
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer_stream(self, request_bytes: bytes, address: tuple[str, int], writer: asyncio.StreamWriter):
+        dns_response = self.fast_answer(request_bytes, address, True)
+        if dns_response is not None:
+            if not writer.is_closing():
+                writer.write(frame(dns_response))
+            return
+
+        started = time.perf_counter()
+        try:
+            request = bytes2request(request_bytes)
+        except Exception:
+            return
+        parsed = time.perf_counter()
+        self.log_request(request, address)
+
+        dns_response = self.from_cache(request)
+        cached = time.perf_counter()
+        forwarded = None
+        if dns_response == b'':
+            dns_response = await self.forward(request, request_bytes)
+            forwarded = time.perf_counter() - cached
+        self.metrics.query(parsed - started, cached - parsed, forwarded, dns_response, True)
+        if not writer.is_closing():
+            writer.write(frame(dns_response))
+            self.log.write(request.header.id, '\t[{}] Отправлено {}', request.header.id, address)
+
+    async def answer_from_forwarder(self, request: DnsPackage, request_bytes: bytes, address: tuple[str, int],
+                                    parse: float, cache: float):
+        started = time.perf_counter()
+        dns_response = self.fit_udp(request, await self.forward(request, request_bytes))
+        self.metrics.query(parse, cache, time.perf_counter() - started, dns_response, False)
+        self.send(dns_response, address, request.header.id)
+
+    async def forward(self, request: DnsPackage, request_bytes: bytes) -> bytes:
+        key = (request.header.rd, request.edns is not None,
+               tuple((q.qname, q.qtype, q.qclass) for q in request.queries))
+        forwarding = self.inflight.get(key)
+        if forwarding is None:
+            forwarding = self.loop.create_task(self.from_forwarder_async(request, request_bytes))
+            self.inflight[key] = forwarding
+            forwarding.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.metrics.count('coalesced')
+            self.log.write(request.header.id, '\t[{}] Ожидание уже отправленного запроса к {}',
+                           request.header.id, self.upstreams)
+
+        return with_response_id(await asyncio.shield(forwarding), request.header.id)
+
+    async def from_forwarder_async(self, dns_request: DnsPackage, request_bytes: bytes) -> bytes:
+        self.log.write(dns_request.header.id, '\t[{}] Не найдены кешированные записи. Обращение к {}...',
+                       dns_request.header.id, self.resolver or self.upstreams)
+        try:
+            self.check_forwarder_loop(dns_request)
+            response_bytes, upstream = await self.lookup_async(dns_request, request_bytes)
+            self.log.write(dns_request.header.id, '\t[{}] Получен ответ от {}', dns_request.header.id, upstream)
+            if self.cache_response(response_bytes).edns is None:
+                # an upstream without EDNS0 answered, the client still gets OPT back
+                response_bytes = self.with_edns(dns_request, response_bytes)
+            return response_bytes
+
+        except Exception:
+            self.metrics.count('upstream_failures')
+            self.log.write(dns_request.header.id, '\t[{}] Вышестоящий сервер недоступен', dns_request.header.id)
+            return self.stale_from_cache(dns_request) or \
+                dns_package_with_internal_error(dns_request.header.id, dns_request.queries) \
+                .with_edns(self.response_edns(dns_request)).to_bytes()
+
+    async def lookup_async(self, dns_request: DnsPackage, request_bytes: bytes) -> (bytes, Upstream):
+        if self.resolver is not None:
+            response = await self.resolver.resolve_async(self.single_query(dns_request), self.forwarder)
+            return self.resolved(dns_request, response), self.resolver
+
+        response_bytes, upstream = await self.exchange_async(request_bytes)
+        if is_truncated(response_bytes):
+            self.metrics.count('tcp_fallbacks')
+            self.log.write(dns_request.header.id, '\t[{}] Ответ от {} обрезан, повтор запроса по TCP',
+                           dns_request.header.id, upstream)
+            response_bytes = await self.tcp_upstreams.query_async(upstream.address, request_bytes)
+        return response_bytes, upstream
+
+    async def exchange_async(self, request_bytes: bytes) -> (bytes, Upstream):
+        # the same request is hedged to the next upstream when the best one is silent longer than its p95 rtt
+        # or fails right away; the first answer wins and the other query is cancelled
+        ranked = self.upstreams.ranked()[:MAX_HEDGED_UPSTREAMS]
+        pending: dict[asyncio.Task, (Upstream, float)] = {}
+
+        def hedge(upstream: Upstream):
+            pending[self.loop.create_task(self.query_upstream(upstream, request_bytes))] = (upstream, self.loop.time())
+
+        hedge(ranked[0])
+        hedges = iter(ranked[1:])
+        hedge_at = self.loop.time() + ranked[0].hedge_delay()
+        try:
+            while len(pending) > 0:
+                timeout = max(hedge_at - self.loop.time(), 0) if hedge_at is not None else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    upstream, _ = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result(), upstream
+                if hedge_at is not None:
+                    upstream = next(hedges, None)
+                    if upstream is None:
+                        hedge_at = None
+                        continue
+                    hedge(upstream)
+        finally:
+            for task, (upstream, sent_at) in pending.items():
+                task.cancel()
+                upstream.record_lost_race(sent_at, self.loop.time(), FORWARDER_TIMEOUT)
+        raise DnsCacheServerException('Upstream servers do not respond')
+
+    async def query_upstream(self, upstream: Upstream, request_bytes: bytes) -> bytes:
+        sent_at = self.loop.time()
+        try:
+            response_bytes = await self.forwarder.query(request_bytes, upstream.address, FORWARDER_TIMEOUT)
+        except Exception:
+            upstream.record_failure()
+            raise
+        upstream.record_success(self.loop.time() - sent_at)
+        return response_bytes
+
+    def refresh(self, key: (str, int, int)):
+        if key[1] != NXDOMAIN_TYPE and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.start_task, self.prefetch_async(key))
+
+    def start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def warm_up(self, keys: list[(str, int, int)], parallelism: int):
+        while self.forwarder is None and self.active:
+            time.sleep(WARM_UP_POLL_INTERVAL)
+        if self.active:
+            asyncio.run_coroutine_threadsafe(self.warm_up_async(keys, parallelism), self.loop).result()
+
+    async def warm_up_async(self, keys: list[(str, int, int)], parallelism: int):
+        limit = asyncio.Semaphore(parallelism)
+
+        async def fetch(key: (str, int, int)):
+            async with limit:
+                await self.fetch_async(key)
+
+        await asyncio.gather(*(fetch(key) for key in keys))
+
+    async def prefetch_async(self, key: (str, int, int)):
+        self.metrics.count('prefetches')
+        await self.fetch_async(key)
+
+    async def fetch_async(self, key: (str, int, int)):
+        request_bytes = self.prefetch_request(key)
+        request_id = int.from_bytes(request_bytes[:2], 'big')
+        self.log.write(request_id, '\tОбновление {} type {} в кеше', key[0], key[1])
+        try:
+            response_bytes, _ = await self.lookup_async(bytes2request(request_bytes), request_bytes)
+            self.cache_response(response_bytes)
+        except Exception:
+            self.refresh_failed(key)
+            self.log.write(request_id, '\tНе удалось обновить {} type {}', key[0], key[1])
+
+    def send(self, dns_response: bytes, address: tuple[str, int], request_id: int):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.sendto(dns_response, address)
+        self.log.write(request_id, '\t[{}] Отправлено {}', request_id, address)
@@ -1,7 +1,13 @@
-import pickle
+import heapq
+import struct
 import time
+from collections import OrderedDict
 from datetime import datetime as date
-from multiprocessing import Process, Lock
+from threading import Thread, Event, Lock
+from typing import Callable
+
+from dns_hot_names import HotNames, HOT_NAMES, read_hot_names, write_hot_names, key_to_question
+from dns_snapshot import read_snapshot, write_snapshot, append_snapshot
 
 T1970 = date(1970, 1, 1)
 
@@ -14,99 +20,474 @@ def seconds_now():
     return in_seconds(date.now())
 
 
-class DnsCache:
-    def __init__(self, cache=None):
+# approximate memory taken by a cache key (its entry, eviction and expiry bookkeeping) besides the name and arena
+KEY_OVERHEAD = 480
+PROTECTED_SHARE = 0.8
+EXPIRE_BATCH = 256
+EXPIRE_TICK = 1
+STALE_WINDOW = 24 * 60 * 60
+STALE_TTL = 30
+REFRESH_HITS = 5
+REFRESH_FRACTION = 0.1
+CACHE_SHARDS = 16
+LOAD_BATCH = 1000
+LOAD_WAIT_TIMEOUT = 30
+CHECKPOINT_INTERVAL = 60
+COMPACT_EVERY_CHECKPOINTS = 10
+
+# expires (seconds since 1970), ttl, data length
+PACKED_RECORD = struct.Struct('!IIH')
+
+
+class _CacheEntry:
+    # all records of a key are packed into one bytes arena instead of a dict of tuples per key:
+    # | expires: 4 | ttl: 4 | length: 2 | data | expires: 4 | ...
+    __slots__ = ('arena', 'size', 'hits', 'refreshing', 'protected', 'scheduled')
+
+    def __init__(self):
+        self.arena = b''
+        self.size = 0
+        self.hits = 0
+        self.refreshing = False
+        self.protected = False
+        # expiry time the key is queued in the heap with, 0 when it is not queued
+        self.scheduled = 0
+
+    def records(self):
+        arena = self.arena
+        offset = 0
+        while offset < len(arena):
+            expires, ttl, length = PACKED_RECORD.unpack_from(arena, offset)
+            offset += PACKED_RECORD.size
+            yield arena[offset:offset + length], expires, ttl
+            offset += length
+
+    def expires(self, data: bytes) -> int | None:
+        for known, expires, _ in self.records():
+            if known == data:
+                return expires
+        return None
+
+    def store(self, data: bytes, expires: int, ttl: int):
+        records = [record for record in self.records() if record[0] != data]
+        records.append((data, expires, ttl))
+        self.pack(records)
+
+    def pack(self, records: list[(bytes, int, int)]):
+        self.arena = b''.join(PACKED_RECORD.pack(expires, ttl, len(data)) + data for data, expires, ttl in records)
+
+
+class _CacheShard:
+    def __init__(self, max_memory: int = None, stale_window: int = STALE_WINDOW,
+                 refresh_fraction: float = REFRESH_FRACTION, refresh_hits: int = REFRESH_HITS):
         self.locker = Lock()
-        self.cache: dict[(str, int, int), dict[bytes, (int, int)]] = {} if cache is None else cache
-        # {
-        #     'name, type, class':[
-        #          {
-        #              b'192.168.0.1': {
-        #                  ('cached_time': seconds since 1970
-        #                  'ttl': seconds)
-        #               }
-        #          }
-        #      ]
-        # }
+        # segmented LRU: new keys enter probation and are promoted to protected on a hit,
+        # so a scan of one-time names only pushes other one-time names out.
+        # Both segments map 'name, type, class' to the entry with all records of the key
+        self.probation: OrderedDict[(str, int, int), _CacheEntry] = OrderedDict()
+        self.protected: OrderedDict[(str, int, int), _CacheEntry] = OrderedDict()
+        self.max_memory = max_memory
+        self.memory = 0
+        self.protected_memory = 0
+        self.evictions = 0
 
-    def get(self, qname: str, qtype: int, qclass: int):
+        # min-heap of (expires, key); an item is actual only while it matches the scheduled time of the entry
+        self.expiry: list[(int, (str, int, int))] = []
+        # expired records stay for stale_window seconds to be served when the forwarder fails (RFC 8767)
+        self.stale_window = stale_window
+        # a key hit refresh_hits times is fetched again when the last refresh_fraction of its ttl is left
+        self.refresh_fraction = refresh_fraction
+        self.refresh_hits = refresh_hits
+
+        # records put since the last checkpoint, kept only while somebody checkpoints them
+        self.journal: list[((str, int, int), bytes, (int, int))] | None = None
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def get(self, key: (str, int, int), now: int, due: list[(str, int, int)]):
         with self.locker:
-            result = []
-            key = (qname, qtype, qclass)
-            now = seconds_now()
-            if key not in self.cache:
+            return self._get(key, now, due)
+
+    def get_many(self, keys: list[(str, int, int)], now: int, due: list[(str, int, int)]):
+        with self.locker:
+            return [self._get(key, now, due) for key in keys]
+
+    def get_stale(self, key: (str, int, int), now: int):
+        with self.locker:
+            entry = self._entry(key)
+            if entry is None:
                 return []
-            for data in self.cache[key]:
-                cached_time, ttl = self.cache[key][data]
-                ttl -= now - cached_time
-                if ttl > 0:
-                    result.append((data, ttl))
-            return result
+            return [(data, STALE_TTL) for data, expires, _ in entry.records()
+                    if expires <= now <= expires + self.stale_window]
 
-    def put(self, rname: str, rtype: int, rclass: int, ttl: int, data: bytes):
+    def put(self, key: (str, int, int), ttl: int, data: bytes, now: int):
+        with self.locker:
+            self._store(key, data, now + ttl, ttl)
+            if self.journal is not None:
+                self.journal.append((key, data, (now, ttl)))
+            self._evict()
+
+    def refresh_failed(self, key: (str, int, int)):
+        # the key may be refreshed again, after as many hits as the first time
         with self.locker:
-            key = (rname, rtype, rclass)
-            value = (seconds_now(), ttl)
-            if key not in self.cache:
-                self.cache[key] = {}
-            self.cache[key][data] = value
-
-    def remove_outdated(self):
-        to_remove_keys = []
+            entry = self._entry(key)
+            if entry is not None:
+                entry.refreshing = False
+                entry.hits = 0
+
+    def take_journal(self) -> list[((str, int, int), bytes, (int, int))]:
+        with self.locker:
+            journal = self.journal
+            self.journal = [] if journal is not None else None
+            return [] if journal is None else journal
+
+    def records(self) -> list[((str, int, int), bytes, (int, int))]:
+        with self.locker:
+            return [(key, data, (expires - ttl, ttl))
+                    for segment in (self.probation, self.protected) for key, entry in segment.items()
+                    for data, expires, ttl in entry.records()]
+
+    def to_dict(self) -> dict[(str, int, int), dict[bytes, (int, int)]]:
         with self.locker:
-            for key in self.cache:
-                to_remove_records = []
-                now = seconds_now()
-                for data in self.cache[key]:
-                    cached_time, ttl = self.cache[key][data]
-                    if now - cached_time > ttl:
-                        to_remove_records.append(data)
-
-                for record in to_remove_records:
-                    self.cache[key].pop(record)
-                if len(self.cache[key]) == 0:
-                    to_remove_keys.append(key)
-            for key in to_remove_keys:
-                self.cache.pop(key)
+            return {key: {data: (expires - ttl, ttl) for data, expires, ttl in entry.records()}
+                    for segment in (self.probation, self.protected) for key, entry in segment.items()}
+
+    def merge(self, cache: dict):
+        with self.locker:
+            for key, records in cache.items():
+                entry = self._entry(key)
+                for data, (cached_time, ttl) in records.items():
+                    if entry is not None:
+                        known = entry.expires(data)
+                        if known is not None and known >= cached_time + ttl:
+                            continue
+                    self._store(key, data, cached_time + ttl, ttl)
+                    entry = self._entry(key)
+            self._evict()
+
+    def expire(self, max_records: int = EXPIRE_BATCH) -> int:
+        # every popped heap item counts toward the batch, outdated ones too, so one tick holds the lock briefly
+        expired = 0
+        popped = 0
+        with self.locker:
+            now = seconds_now()
+            while len(self.expiry) > 0 and self.expiry[0][0] < now and popped < max_records:
+                popped += 1
+                scheduled, key = heapq.heappop(self.expiry)
+                entry = self._entry(key)
+                if entry is None or entry.scheduled != scheduled:
+                    continue
+                records = list(entry.records())
+                alive = [record for record in records if now <= record[1] + self.stale_window]
+                expired += len(records) - len(alive)
+                if len(alive) == 0:
+                    self._remove(key, entry)
+                    continue
+                entry.pack(alive)
+                self._resize(key, entry)
+                self._schedule(key, entry, min(expires for _, expires, _ in alive) + self.stale_window)
+        return expired
+
+    def _entry(self, key: (str, int, int)) -> _CacheEntry | None:
+        entry = self.protected.get(key)
+        return entry if entry is not None else self.probation.get(key)
+
+    def _get(self, key: (str, int, int), now: int, due: list[(str, int, int)]):
+        result = []
+        entry = self._entry(key)
+        if entry is None:
+            return result
+        self._touch(key, entry)
+        refresh = False
+        arena = entry.arena
+        offset = 0
+        while offset < len(arena):
+            expires, ttl, length = PACKED_RECORD.unpack_from(arena, offset)
+            offset += PACKED_RECORD.size + length
+            left = expires - now
+            if left > 0:
+                result.append((arena[offset - length:offset], left))
+                refresh |= left <= ttl * self.refresh_fraction
+        if len(result) > 0:
+            entry.hits += 1
+            if refresh and entry.hits >= self.refresh_hits and not entry.refreshing:
+                entry.refreshing = True
+                due.append(key)
+        return result
+
+    def _store(self, key: (str, int, int), data: bytes, expires: int, ttl: int):
+        entry = self._entry(key)
+        if entry is None:
+            entry = _CacheEntry()
+            self.probation[key] = entry
+        entry.store(data, expires, ttl)
+        self._resize(key, entry)
+        entry.hits = 0
+        entry.refreshing = False
+        expires += self.stale_window
+        if entry.scheduled == 0 or expires < entry.scheduled:
+            self._schedule(key, entry, expires)
+
+    def _schedule(self, key: (str, int, int), entry: _CacheEntry, expires: int):
+        entry.scheduled = expires
+        heapq.heappush(self.expiry, (expires, key))
+        # evicted and rescheduled keys leave outdated items behind; once they outnumber the keys,
+        # the heap is built again from the entries, so it stays within twice the number of keys
+        if len(self.expiry) > 2 * len(self) + EXPIRE_BATCH:
+            self.expiry = [(entry.scheduled, key)
+                           for segment in (self.probation, self.protected) for key, entry in segment.items()]
+            heapq.heapify(self.expiry)
+
+    def _touch(self, key: (str, int, int), entry: _CacheEntry):
+        if entry.protected:
+            self.protected.move_to_end(key)
+            return
+        del self.probation[key]
+        self.protected[key] = entry
+        entry.protected = True
+        self.protected_memory += entry.size
+        if self.max_memory is None:
+            return
+        while self.protected_memory > self.max_memory * PROTECTED_SHARE and len(self.protected) > 1:
+            demoted_key, demoted = self.protected.popitem(last=False)
+            demoted.protected = False
+            self.protected_memory -= demoted.size
+            self.probation[demoted_key] = demoted
+
+    def _resize(self, key: (str, int, int), entry: _CacheEntry):
+        size = KEY_OVERHEAD + len(key[0]) + len(entry.arena)
+        delta = size - entry.size
+        entry.size = size
+        self.memory += delta
+        if entry.protected:
+            self.protected_memory += delta
+
+    def _remove(self, key: (str, int, int), entry: _CacheEntry):
+        self.memory -= entry.size
+        entry.scheduled = 0
+        if entry.protected:
+            del self.protected[key]
+            self.protected_memory -= entry.size
+        else:
+            del self.probation[key]
+
+    def _evict(self):
+        if self.max_memory is None:
+            return
+        while self.memory > self.max_memory and len(self) > 0:
+            segment = self.probation if len(self.probation) > 0 else self.protected
+            key, entry = next(iter(segment.items()))
+            self._remove(key, entry)
+            self.evictions += 1
+
+
+class DnsCache:
+    def __init__(self, cache=None, max_memory: int = None, shards: int = CACHE_SHARDS,
+                 stale_window: int = STALE_WINDOW, refresh_fraction: float = REFRESH_FRACTION,
+                 refresh_hits: int = REFRESH_HITS):
+        self.max_memory = max_memory
+        self.stale_window = stale_window
+        self.refresh_fraction = refresh_fraction
+        self.refresh_hits = refresh_hits
+        shard_memory = None if max_memory is None else max_memory // shards
+        self.shards = [_CacheShard(shard_memory, stale_window, refresh_fraction, refresh_hits)
+                       for _ in range(shards)]
+        self.merged_evictions = 0
+        # called with a key when a hot record nears its expiry and should be fetched again
+        self.on_refresh: Callable[[(str, int, int)], None] | None = None
+        if cache is not None:
+            self.merge(cache)
+
+    @property
+    def evictions(self) -> int:
+        return self.merged_evictions + sum(shard.evictions for shard in self.shards)
+
+    @property
+    def memory(self) -> int:
+        return sum(shard.memory for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def shard(self, key: (str, int, int)) -> _CacheShard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, qname: str, qtype: int, qclass: int):
+        key = (qname, qtype, qclass)
+        due = []
+        result = self.shard(key).get(key, seconds_now(), due)
+        self._request_refresh(due)
+        return result
+
+    def get_many(self, keys: list[(str, int, int)]):
+        now = seconds_now()
+        due = []
+        results = [None] * len(keys)
+        by_shard: dict[int, list[int]] = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(hash(key) % len(self.shards), []).append(i)
+        for shard_index, indexes in by_shard.items():
+            shard_results = self.shards[shard_index].get_many([keys[i] for i in indexes], now, due)
+            for i, result in zip(indexes, shard_results):
+                results[i] = result
+        self._request_refresh(due)
+        return results
+
+    def get_stale(self, qname: str, qtype: int, qclass: int):
+        key = (qname, qtype, qclass)
+        return self.shard(key).get_stale(key, seconds_now())
+
+    def _request_refresh(self, due: list[(str, int, int)]):
+        if self.on_refresh is None:
+            return
+        for key in due:
+            self.on_refresh(key)
+
+    def refresh_failed(self, key: (str, int, int)):
+        self.shard(key).refresh_failed(key)
+
+    def put(self, rname: str, rtype: int, rclass: int, ttl: int, data: bytes):
+        key = (rname, rtype, rclass)
+        self.shard(key).put(key, ttl, data, seconds_now())
+
+    def merge(self, cache: dict, evictions: int = 0):
+        self.merged_evictions += evictions
+        by_shard: dict[int, dict] = {}
+        for key, records in cache.items():
+            by_shard.setdefault(hash(key) % len(self.shards), {})[key] = records
+        for shard_index, shard_cache in by_shard.items():
+            self.shards[shard_index].merge(shard_cache)
+
+    def enable_journal(self):
+        for shard in self.shards:
+            shard.journal = []
+
+    def take_journal(self) -> list[((str, int, int), bytes, (int, int))]:
+        return [record for shard in self.shards for record in shard.take_journal()]
+
+    def records(self) -> list[((str, int, int), bytes, (int, int))]:
+        return [record for shard in self.shards for record in shard.records()]
+
+    def to_dict(self) -> dict[(str, int, int), dict[bytes, (int, int)]]:
+        cache = {}
+        for shard in self.shards:
+            cache.update(shard.to_dict())
+        return cache
+
+    def expire(self, max_records: int = EXPIRE_BATCH) -> int:
+        return sum(shard.expire(max_records) for shard in self.shards)
+
+    def run_expiry(self):
+        while True:
+            while self.expire() >= EXPIRE_BATCH:
+                pass
+            time.sleep(EXPIRE_TICK)
 
 
 class DnsCacheController:
-    def __init__(self, name='dns_cache.bin'):
+    def __init__(self, name='dns_cache.bin', max_memory: int = None, stale_window: int = STALE_WINDOW,
+                 hot_names: int = HOT_NAMES, checkpoints: bool = True,
+                 refresh_fraction: float = REFRESH_FRACTION, refresh_hits: int = REFRESH_HITS):
         self.cache: DnsCache
         self.filename = name
-        self.gc = Process(target=self.cache_gc, daemon=True)
+        # with worker processes the puts go to their own caches, which only come back on stop
+        self.checkpoints = checkpoints
+        # the most queried names are kept next to the cache and asked again at startup
+        self.hot_filename = name + '.hot'
+        self.hot_names = HotNames(hot_names)
+        self.warm_up_keys: list[(str, int, int)] = []
+        self.max_memory = max_memory
+        self.stale_window = stale_window
+        self.refresh_fraction = refresh_fraction
+        self.refresh_hits = refresh_hits
+        self.saving = Lock()
+        self.loaded = Event()
 
     def __enter__(self):
-        if not self.load_cache():
-            self.cache = DnsCache()
-        self.gc.start()
+        # the server starts answering right away while the snapshot is loaded in the background
+        self.cache = DnsCache(max_memory=self.max_memory, stale_window=self.stale_window,
+                              refresh_fraction=self.refresh_fraction, refresh_hits=self.refresh_hits)
+        if self.checkpoints:
+            self.cache.enable_journal()
+        Thread(target=self.cache.run_expiry, daemon=True).start()
+        self.load_hot_names()
+        Thread(target=self.load_and_checkpoint, daemon=True).start()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.save_cache()
+        if self.loaded.wait(LOAD_WAIT_TIMEOUT):
+            self.save_cache()
+            return
+        # a compacting save would replace the snapshot with a part of it, and even an append could be cut off
+        # by the loader, which still reads the file; the snapshot is left as it is
+        print('Кеш не сохранён: загрузка снимка ещё не закончена')
+        self.save_hot_names()
+
+    def load_and_checkpoint(self):
+        self.load_cache()
+        self.loaded.set()
+        if not self.checkpoints:
+            return
+        checkpoints = 0
+        while True:
+            time.sleep(CHECKPOINT_INTERVAL)
+            checkpoints += 1
+            if checkpoints % COMPACT_EVERY_CHECKPOINTS == 0:
+                self.save_cache()
+            else:
+                self.checkpoint()
 
     def load_cache(self):
         print(f'Начата загрузка кеша из файла {self.filename}')
         try:
-            with open(self.filename, 'rb') as file:
-                loaded_cache = pickle.load(file)
-                self.cache = DnsCache(loaded_cache)
-            print(f'Успешно загружено {len(self.cache.cache)} записей')
+            loaded = 0
+            batch = {}
+            for key, data, value in read_snapshot(self.filename, seconds_now()):
+                batch.setdefault(key, {})[data] = value
+                loaded += 1
+                if loaded % LOAD_BATCH == 0:
+                    self.cache.merge(batch)
+                    batch = {}
+            self.cache.merge(batch)
+            print(f'Успешно загружено {loaded} записей')
             return True
         except:
             print('Не удалось загрузить dns кеш')
             return False
 
-    def save_cache(self):
-        print(f'Начато сохранение кеша в файл {self.filename}')
+    def load_hot_names(self):
+        try:
+            hot_names = read_hot_names(self.hot_filename)
+        except OSError:
+            return
+        self.warm_up_keys = [key for key, _ in hot_names]
+        # counts of the previous runs fade by half on every start, the list follows what is popular now
+        self.hot_names.merge({key_to_question(key): count // 2 for key, count in hot_names if count > 1})
+
+    def save_hot_names(self):
+        if self.hot_names.capacity == 0:
+            return
         try:
-            with open(self.filename, 'wb') as file:
-                pickle.dump(self.cache.cache, file)
-            print(f'Кеш успешно сохранён')
+            write_hot_names(self.hot_filename, self.hot_names.top())
         except:
-            print('Не удалось сохранить dns кеш')
+            print('Не удалось сохранить список популярных имён')
 
-    def cache_gc(self):
-        while True:
-            self.cache.remove_outdated()
-            time.sleep(10)
+    def checkpoint(self):
+        with self.saving:
+            try:
+                append_snapshot(self.filename, self.cache.take_journal())
+            except:
+                print('Не удалось сохранить контрольную точку dns кеша')
+
+    def save_cache(self):
+        print(f'Начато сохранение кеша в файл {self.filename}')
+        print(f'Вытеснено из кеша за время работы: {self.cache.evictions} записей')
+        with self.saving:
+            try:
+                self.cache.take_journal()
+                write_snapshot(self.filename, self.cache.records())
+                print(f'Кеш успешно сохранён')
+            except:
+                print('Не удалось сохранить dns кеш')
+        self.save_hot_names()
@@ -0,0 +1,94 @@
+import os
+from threading import Lock
+
+from dns_models import QUESTION, qname2bytes, question_key
+from dns_parser import read_qname
+
+HOT_NAMES = 1000
+# one query of this many is counted, the order of the popular names stays the same
+HOT_SAMPLE_EVERY = 8
+
+
+class HotNames:
+    # space-saving top-K with batched eviction: when the table doubles, the least counted half is dropped at once
+    # and names seen later start from the largest dropped count, so a popular name may be overestimated, never lost
+    def __init__(self, capacity: int = HOT_NAMES, sample_every: int = HOT_SAMPLE_EVERY):
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.locker = Lock()
+        # question key -> count
+        self.counts: dict[bytes, int] = {}
+        self.floor = 0
+
+    def record(self, question: bytes):
+        # capacity 0 turns the list off
+        if self.capacity == 0:
+            return
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.sample_every
+        key = question_key(question)
+        with self.locker:
+            self.counts[key] = self.counts.get(key, self.floor) + 1
+            if len(self.counts) >= 2 * self.capacity:
+                self._prune()
+
+    def merge(self, counts: dict[bytes, int]):
+        if self.capacity == 0:
+            return
+        with self.locker:
+            for key, count in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+            if len(self.counts) >= 2 * self.capacity:
+                self._prune()
+
+    def top(self) -> list[(bytes, int)]:
+        with self.locker:
+            return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:self.capacity]
+
+    def to_dict(self) -> dict[bytes, int]:
+        with self.locker:
+            return dict(self.counts)
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        if len(ranked) <= self.capacity:
+            return
+        self.floor = ranked[self.capacity][1]
+        self.counts = dict(ranked[:self.capacity])
+
+
+def question_to_key(question: bytes) -> (str, int, int):
+    qname, offset = read_qname(memoryview(question), 0)
+    qtype, qclass = QUESTION.unpack_from(question, offset)
+    return qname, qtype, qclass
+
+
+def write_hot_names(filename: str, top: list[(bytes, int)]):
+    # one "count name type class" line per name, the most popular first
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        for question, count in top:
+            qname, qtype, qclass = question_to_key(question)
+            file.write(f'{count} {qname or "."} {qtype} {qclass}\n')
+    os.replace(temp_filename, filename)
+
+
+def read_hot_names(filename: str) -> list[((str, int, int), int)]:
+    hot_names = []
+    with open(filename, encoding='utf-8') as file:
+        for line in file:
+            try:
+                count, qname, qtype, qclass = line.split()
+                key = ('' if qname == '.' else qname, int(qtype), int(qclass))
+                hot_names.append((key, int(count)))
+            except ValueError:
+                continue
+    return hot_names
+
+
+def key_to_question(key: (str, int, int)) -> bytes:
+    return question_key(qname2bytes(key[0]) + QUESTION.pack(key[1], key[2]))
+
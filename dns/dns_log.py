@@ -0,0 +1,69 @@
+import sys
+import time
+from collections import deque
+from threading import Thread, Event
+
+LOG_BUFFER_SIZE = 65536
+LOG_FLUSH_INTERVAL = 1
+SAMPLE_SCALE = 0x10000
+
+
+class QueryLog:
+    # per-request messages are only queued on the hot path; formatting and output happen in a background thread.
+    # requests are sampled by id, so either all messages of a request are written or none
+    def __init__(self, sample_rate: float = 0.0, filename: str | None = None,
+                 buffer_size: int = LOG_BUFFER_SIZE, flush_interval: float = LOG_FLUSH_INTERVAL):
+        self.threshold = int(min(max(sample_rate, 0.0), 1.0) * SAMPLE_SCALE)
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.buffer: deque[(str, tuple)] = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.stopped = Event()
+        self.demon = Thread(target=self.run, daemon=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def sampled(self, request_id: int) -> bool:
+        # multiplicative hash spreads sequential client ids over the whole range
+        return (request_id * 0x9E3779B1 >> 8) % SAMPLE_SCALE < self.threshold
+
+    def write(self, request_id: int, message: str, *args):
+        if self.threshold == 0 or not self.sampled(request_id):
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((message, args))
+
+    def start(self):
+        if self.enabled:
+            self.demon.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.demon.is_alive():
+            self.demon.join()
+
+    def run(self):
+        output = sys.stdout if self.filename is None else open(self.filename, 'a', encoding='utf-8')
+        try:
+            while not self.stopped.wait(self.flush_interval):
+                self.flush(output)
+            self.flush(output)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    def flush(self, output):
+        lines = []
+        while len(self.buffer) > 0:
+            message, args = self.buffer.popleft()
+            lines.append(message.format(*args))
+        if self.dropped > 0:
+            lines.append(f'{time.strftime("%H:%M:%S")} Журнал переполнен, пропущено {self.dropped} сообщений')
+            self.dropped = 0
+        if len(lines) > 0:
+            output.write('\n'.join(lines) + '\n')
+            output.flush()
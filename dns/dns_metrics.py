@@ -0,0 +1,175 @@
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, Event
+from typing import Callable
+
+from dns_log import QueryLog
+
+# bucket i counts latencies below 2^i microseconds, the last one is everything above ~8 s
+HISTOGRAM_BUCKETS = 24
+METRICS_DUMP_INTERVAL = 10
+STAGES = ('parse', 'cache', 'forward', 'encode', 'fast')
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        bucket = int(seconds * 1_000_000).bit_length()
+        self.counts[bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, share: float) -> float:
+        rank = share * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return (1 << bucket) / 1_000_000
+        return 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self.locker = Lock()
+        self.counters: Counter[str] = Counter()
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self.started = time.monotonic()
+        self.last_render = (self.started, 0)
+
+    def count(self, name: str, value: int = 1):
+        with self.locker:
+            self.counters[name] += value
+
+    def observe(self, stage: str, seconds: float):
+        with self.locker:
+            self.histograms[stage].observe(seconds)
+
+    def query(self, parse: float, cache: float, forward: float | None, response: bytes, tcp: bool,
+              fast: bool = False):
+        # everything known about an answered query is recorded under a single lock acquisition
+        with self.locker:
+            self.counters['queries'] += 1
+            if fast:
+                self.counters['fast_path'] += 1
+            self.counters['cache_misses' if forward is not None else 'cache_hits'] += 1
+            if tcp:
+                self.counters['tcp_queries'] += 1
+            if len(response) > 3:
+                self.counters[f'rcode_{response[3] & 0b1111}'] += 1
+            # a fast path answer is never parsed, its whole lookup goes to a stage of its own,
+            # so parse and cache keep describing the queries that went the full way
+            if fast:
+                self.histograms['fast'].observe(cache)
+            else:
+                self.histograms['parse'].observe(parse)
+                self.histograms['cache'].observe(cache)
+            if forward is not None:
+                self.histograms['forward'].observe(forward)
+
+    def gauge(self, name: str, value: Callable[[], float]):
+        self.gauges[name] = value
+
+    def render(self) -> str:
+        # prometheus text exposition format, readable by eye as well
+        now = time.monotonic()
+        with self.locker:
+            counters = dict(self.counters)
+            histograms = {stage: (list(h.counts), h.total, h.sum, h.percentile(0.5), h.percentile(0.99))
+                          for stage, h in self.histograms.items()}
+            last_time, last_queries = self.last_render
+            self.last_render = (now, counters.get('queries', 0))
+
+        lines = [f'dns_uptime_seconds {now - self.started:.0f}',
+                 f'dns_qps {(counters.get("queries", 0) - last_queries) / max(now - last_time, 1e-9):.1f}']
+        for name, value in sorted(counters.items()):
+            lines.append(f'dns_{name}_total {value}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'dns_{name} {value()}')
+        for stage, (counts, total, seconds, p50, p99) in histograms.items():
+            seen = 0
+            for bucket, count in enumerate(counts[:-1]):
+                seen += count
+                lines.append(f'dns_latency_seconds_bucket{{stage="{stage}",le="{(1 << bucket) / 1_000_000}"}} {seen}')
+            lines.append(f'dns_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+            lines.append(f'dns_latency_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+            lines.append(f'dns_latency_seconds_count{{stage="{stage}"}} {total}')
+            lines.append(f'dns_latency_p50_seconds{{stage="{stage}"}} {p50}')
+            lines.append(f'dns_latency_p99_seconds{{stage="{stage}"}} {p99}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    def __init__(self, metrics: Metrics, port: int | None = None, filename: str | None = None,
+                 interval: float = METRICS_DUMP_INTERVAL):
+        self.metrics = metrics
+        self.port = port
+        self.filename = filename
+        self.interval = interval
+        self.http: ThreadingHTTPServer | None = None
+        self.stopped = Event()
+        self.demon = Thread(target=self.run_dump, daemon=True)
+
+    def start(self):
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.http = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            Thread(target=self.http.serve_forever, daemon=True).start()
+        if self.filename is not None:
+            self.demon.start()
+        return self
+
+    def stop(self):
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+        self.stopped.set()
+        if self.demon.is_alive():
+            self.demon.join()
+
+    def run_dump(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def dump(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            file.write(self.metrics.render())
+        os.replace(temp_filename, self.filename)
+
+
+@dataclass
+class TelemetryOptions:
+    log_sample: float = 0.0
+    log_file: str | None = None
+    metrics_port: int | None = None
+    metrics_file: str | None = None
+
+    def attach(self, server, index: int = 0) -> MetricsExporter:
+        # every worker process exports its own metrics on the next port and into its own file
+        server.log = QueryLog(self.log_sample, self.log_file).start()
+        port = None if self.metrics_port is None else self.metrics_port + index
+        filename = self.metrics_file if self.metrics_file is None or index == 0 else f'{self.metrics_file}.{index}'
+        return MetricsExporter(server.metrics, port, filename).start()
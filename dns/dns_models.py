@@ -1,11 +1,31 @@
 import struct
-from dns_utils import byte_at
 from dataclasses import dataclass
+from functools import lru_cache
 
 DNS_RECORD_TYPES = {1: 'a', 2: 'ns', 5: 'cname', 6: 'soa', 12: 'ptr', 15: 'mx', 16: 'txt', 28: 'aaaa'}
+SOA_TYPE = 6
+OPT_TYPE = 41
+# type 0 is reserved, so negative entries for a whole non-existent name are cached under it
+NXDOMAIN_TYPE = 0
+NOERROR = 0
+NXDOMAIN = 3
+
+HEADER = struct.Struct('!6H')
+QUESTION = struct.Struct('!2H')
+RECORD = struct.Struct('!2HIH')
+POINTER = struct.Struct('!H')
+SOA_MINIMUM = struct.Struct('!I')
+MAX_POINTER = 0x3FFF
+UDP_PACKAGE_SIZE = 512
+# RFC 6891 payload size advertised by default, small enough to avoid IP fragmentation (DNS flag day 2020)
+EDNS_PAYLOAD_SIZE = 1232
+MAX_PACKAGE_SIZE = 65535
+ENCODED_NAMES_CACHE_SIZE = 4096
 
 
 class DnsQuery:
+    __slots__ = ('qname', 'qtype', 'qclass')
+
     def __init__(self, qname: str, qtype: int, qclass: int):
         self.qname = qname
         self.qtype = qtype
@@ -13,11 +33,15 @@ class DnsQuery:
 
     def to_bytes(self):
         name = qname2bytes(self.qname)
-        bytes_query = struct.pack("!" + str(len(name)) + 's2h', name, self.qtype, self.qclass)
+        bytes_query = struct.pack("!" + str(len(name)) + 's2H', name, self.qtype, self.qclass)
         return bytes_query
 
+    def write(self, writer: 'PackageWriter'):
+        writer.write_name(self.qname)
+        writer.write_struct(QUESTION, self.qtype, self.qclass)
+
 
-@dataclass
+@dataclass(slots=True)
 class DnsResourceRecord:
     name: str
     rtype: int
@@ -28,11 +52,41 @@ class DnsResourceRecord:
 
     def to_bytes(self):
         name = qname2bytes(self.name)
-        return struct.pack(f'!{len(name)}s2hIH{self.rd_length}s',
+        return struct.pack(f'!{len(name)}s2HIH{self.rd_length}s',
                            name, self.rtype, self.rclass, self.ttl, self.rd_length, self.rdata)
 
+    def write(self, writer: 'PackageWriter'):
+        writer.write_name(self.name)
+        if self.rtype != OPT_TYPE:
+            writer.ttl_offsets.append(writer.length + 4)
+        writer.write_struct(RECORD, self.rtype, self.rclass, self.ttl, self.rd_length)
+        writer.write(self.rdata)
+
+
+@dataclass(slots=True)
+class Edns:
+    payload_size: int = EDNS_PAYLOAD_SIZE
+    extended_rcode: int = 0
+    version: int = 0
+    dnssec_ok: bool = False
+    options: bytes = b''
+
+    def to_record(self) -> DnsResourceRecord:
+        # OPT pseudo-record: class holds the payload size, ttl holds extended rcode, version and flags
+        ttl = (self.extended_rcode & 0xFF) << 24 | (self.version & 0xFF) << 16 | self.dnssec_ok << 15
+        return DnsResourceRecord('', OPT_TYPE, self.payload_size, ttl, len(self.options), self.options)
 
-@dataclass
+    @staticmethod
+    def from_record(record: DnsResourceRecord):
+        return Edns(
+            payload_size=max(record.rclass, UDP_PACKAGE_SIZE),
+            extended_rcode=record.ttl >> 24,
+            version=record.ttl >> 16 & 0xFF,
+            dnssec_ok=record.ttl >> 15 & 1 == 1,
+            options=record.rdata)
+
+
+@dataclass(slots=True)
 class DnsHeader:
     id: int
     qr: bool = True  # is Response
@@ -52,22 +106,23 @@ class DnsHeader:
                  self.aa << 10 | self.tc << 9 | self.rd << 8 |
                  self.ra << 7 | (self.rcode & 0b1111))
 
-        return struct.pack('!6H', self.id, flags, self.qd_count,
-                           self.an_count, self.ns_count, self.ar_count)
+        return HEADER.pack(self.id, flags, self.qd_count, self.an_count, self.ns_count, self.ar_count)
 
     @staticmethod
     def from_bytes(header_bytes: bytes):
-        response_id, flags, qd_count, an_count, ns_count, ar_count = struct.unpack('!6H', header_bytes)
+        return DnsHeader.from_values(*HEADER.unpack(header_bytes))
 
+    @staticmethod
+    def from_values(response_id: int, flags: int, qd_count: int, an_count: int, ns_count: int, ar_count: int):
         return DnsHeader(
             id=response_id,
-            qr=byte_at(flags, 0, 1) == 1,
-            opcode=byte_at(flags, 1, 4),
-            aa=byte_at(flags, 5, 1) == 1,
-            tc=byte_at(flags, 6, 1) == 1,
-            rd=byte_at(flags, 7, 1) == 1,
-            ra=byte_at(flags, 8, 1) == 1,
-            rcode=byte_at(flags, 12, 4),
+            qr=flags >> 15 & 1 == 1,
+            opcode=flags >> 11 & 0b1111,
+            aa=flags >> 10 & 1 == 1,
+            tc=flags >> 9 & 1 == 1,
+            rd=flags >> 8 & 1 == 1,
+            ra=flags >> 7 & 1 == 1,
+            rcode=flags & 0b1111,
             qd_count=qd_count,
             an_count=an_count,
             ns_count=ns_count,
@@ -75,12 +130,16 @@ class DnsHeader:
 
 
 class DnsPackage:
+    __slots__ = ('header', 'queries', 'ans_records', 'auth_records', 'additional_records', 'edns', 'ttl_offsets')
+
     def __init__(self, header: DnsHeader):
         self.header = header
         self.queries: list[DnsQuery] = []
         self.ans_records: list[DnsResourceRecord] = []
         self.auth_records: list[DnsResourceRecord] = []
         self.additional_records: list[DnsResourceRecord] = []
+        self.edns: Edns | None = None
+        self.ttl_offsets: list[int] = []
 
     def with_queries(self, queries: list[DnsQuery]):
         self.queries = queries
@@ -107,16 +166,69 @@ class DnsPackage:
         self.with_auth_records(records[self.header.an_count:self.header.an_count + self.header.ns_count])
         self.with_additional_records(records[self.header.an_count + self.header.ns_count:
                                              self.header.an_count + self.header.ns_count + self.header.ar_count])
+        opt = next((r for r in self.additional_records if r.rtype == OPT_TYPE), None)
+        self.edns = None if opt is None else Edns.from_record(opt)
         return self
 
+    def with_edns(self, edns: Edns | None):
+        self.edns = edns
+        records = [r for r in self.additional_records if r.rtype != OPT_TYPE]
+        return self.with_additional_records(records if edns is None else records + [edns.to_record()])
+
+    def udp_payload_size(self) -> int:
+        return UDP_PACKAGE_SIZE if self.edns is None else self.edns.payload_size
+
+    def to_bytes(self) -> bytes:
+        package_bytes, _ = self.to_bytes_with_ttl_offsets()
+        return package_bytes
+
+    def to_bytes_with_ttl_offsets(self) -> (bytes, list[int]):
+        writer = PackageWriter()
+        writer.write(self.header.to_bytes())
+        for p in self.queries:
+            p.write(writer)
+        for r in self.ans_records + self.auth_records + self.additional_records:
+            r.write(writer)
+        return writer.to_bytes(), writer.ttl_offsets
+
+
+class PackageWriter:
+    __slots__ = ('buffer', 'length', 'names', 'ttl_offsets')
+
+    def __init__(self, size: int = UDP_PACKAGE_SIZE):
+        self.buffer = bytearray(size)
+        self.length = 0
+        # name suffix -> offset of its first occurrence, target for compression pointers
+        self.names: dict[str, int] = {}
+        self.ttl_offsets: list[int] = []
+
+    def reserve(self, size: int):
+        if self.length + size > len(self.buffer):
+            self.buffer.extend(bytes(max(len(self.buffer), self.length + size - len(self.buffer))))
+
+    def write(self, data: bytes):
+        end = self.length + len(data)
+        self.reserve(len(data))
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def write_struct(self, packer: struct.Struct, *values):
+        self.reserve(packer.size)
+        packer.pack_into(self.buffer, self.length, *values)
+        self.length += packer.size
+
+    def write_name(self, name: str):
+        for suffix, label in encoded_labels(name):
+            if suffix in self.names:
+                self.write_struct(POINTER, 0xC000 | self.names[suffix])
+                return
+            if self.length <= MAX_POINTER:
+                self.names[suffix] = self.length
+            self.write(label)
+        self.write(b'\0')
+
     def to_bytes(self) -> bytes:
-        struct_format = '!12s'
-        values = [self.header.to_bytes()]
-        for p in self.queries + self.ans_records + self.auth_records + self.additional_records:
-            part_bytes = p.to_bytes()
-            struct_format += str(len(part_bytes)) + 's'
-            values.append(part_bytes)
-        return struct.pack(struct_format, *values)
+        return bytes(self.buffer[:self.length])
 
 
 def dns_package_with_internal_error(request_id: int, queries):
@@ -124,18 +236,81 @@ def dns_package_with_internal_error(request_id: int, queries):
     return DnsPackage(header).with_queries(queries)
 
 
-def qname2bytes(qname: str):
-    data = []
-    struct_format = '!'
+def truncated_package(package_bytes: bytes, queries: list[DnsQuery], edns: Edns | None = None) -> bytes:
+    # an answer that does not fit into udp keeps only the header and question, the client retries over tcp
+    header = DnsHeader.from_bytes(package_bytes[:HEADER.size])
+    header.tc = True
+    return DnsPackage(header).with_queries(queries).with_ans_records([]) \
+        .with_auth_records([]).with_additional_records([]).with_edns(edns).to_bytes()
+
+
+def with_opt(package_bytes: bytes, payload_size: int) -> bytes:
+    # an empty OPT record appended to a built package, the additional count goes up by one
+    ar_count, = POINTER.unpack_from(package_bytes, 10)
+    return (package_bytes[:10] + POINTER.pack(ar_count + 1) + package_bytes[HEADER.size:] +
+            b'\0' + RECORD.pack(OPT_TYPE, payload_size, 0, 0))
+
+
+def has_opt_at(package_bytes: bytes, offset: int) -> bool:
+    # an OPT record has the root name, so its type follows a single zero byte
+    return package_bytes[offset:offset + 3] == b'\0\0\x29'
+
+
+def question_end(package_bytes: bytes) -> int:
+    # end of the first question read straight from the bytes, 0 if its name is compressed or cut off
+    offset = HEADER.size
+    length = len(package_bytes)
+    while offset < length:
+        label_length = package_bytes[offset]
+        if label_length == 0:
+            end = offset + 1 + QUESTION.size
+            return end if end <= length else 0
+        if label_length & 0b1100_0000:
+            return 0
+        offset += label_length + 1
+    return 0
+
+
+def question_key(question: bytes) -> bytes:
+    # the question as it is on the wire with the name lowercased; type and class are left as they are,
+    # their bytes may look like letters
+    return question[:-QUESTION.size].lower() + question[-QUESTION.size:]
+
+
+def slip_package(request_bytes: bytes) -> bytes:
+    # a TC answer built straight from the request bytes, nothing is parsed: QR and TC are set, opcode and RD kept,
+    # only the single question is copied. b'' for anything that is not a plain one-question query
+    if len(request_bytes) < HEADER.size or request_bytes[2] & 0b1000_0000 or request_bytes[4:6] != b'\0\1':
+        return b''
+    end = question_end(request_bytes)
+    if end == 0:
+        return b''
+    return request_bytes[:2] + bytes((request_bytes[2] & 0b0111_1001 | 0b1000_0010, 0b1000_0000)) + \
+        b'\0\1\0\0\0\0\0\0' + request_bytes[HEADER.size:end]
+
+
+def is_truncated(package_bytes: bytes) -> bool:
+    return len(package_bytes) >= HEADER.size and package_bytes[2] & 0b10 != 0
+
+
+def dns_query_package(request_id: int, queries: list[DnsQuery]):
+    header = DnsHeader(request_id, qr=False, aa=False, ra=False)
+    return DnsPackage(header).with_queries(queries)
+
+
+def with_response_id(package_bytes: bytes, response_id: int) -> bytes:
+    return response_id.to_bytes(2, 'big') + package_bytes[2:]
+
+
+@lru_cache(maxsize=ENCODED_NAMES_CACHE_SIZE)
+def encoded_labels(qname: str) -> tuple[(str, bytes)]:
     labels = qname.split('.')
     if labels[-1] == '':
         labels = labels[:-1]
-    for label in labels:
-        data.append(bytes([len(label)]))
-        data.append(label.encode())
-        struct_format += 'c' + str(len(label)) + 's'
+    return tuple(('.'.join(labels[i:]), bytes([len(label.encode())]) + label.encode())
+                 for i, label in enumerate(labels))
 
-    data.append(b'\0')
-    struct_format += 'c'
 
-    return struct.pack(struct_format, *data)
\ No newline at end of file
+@lru_cache(maxsize=ENCODED_NAMES_CACHE_SIZE)
+def qname2bytes(qname: str):
+    return b''.join(label for _, label in encoded_labels(qname)) + b'\0'
@@ -1,59 +1,142 @@
 import struct
+import sys
 
-from dns_models import DnsQuery, DnsHeader, DnsPackage, DnsResourceRecord
+from dns_models import DnsQuery, DnsHeader, DnsPackage, DnsResourceRecord, qname2bytes
+from dns_models import HEADER, QUESTION, RECORD, OPT_TYPE
+
+MX_PREFERENCE = struct.Struct('!H')
+SOA_NUMBERS_LENGTH = 20
+MAX_NAME_LENGTH = 255
+
+# rdata of these types holds domain names which may point into the original package
+NAME_RDATA_TYPES = {2, 5, 12}
 
 
 def bytes2package(data: bytes) -> DnsPackage:
-    header, queries = struct.unpack(f'!12s{len(data) - 12}s', data)
-    header = DnsHeader.from_bytes(header)
-    queries, records_bytes = bytes2queries(queries, header.qd_count, data)
-    records = bytes2records(records_bytes, data)
-    return DnsPackage(header).with_queries(queries).with_records_from_header(records)
+    view = memoryview(data)
+    names = {}
+    header = DnsHeader.from_values(*HEADER.unpack_from(view))
+    queries, offset = bytes2queries(view, 12, header.qd_count, names)
+    records_count = header.an_count + header.ns_count + header.ar_count
+    package = DnsPackage(header)
+    records, _ = bytes2records(view, offset, records_count, names, package.ttl_offsets)
+    return package.with_queries(queries).with_records_from_header(records)
 
 
-def bytes2queries(queries_bytes: bytes, queries_count: int, body: bytes):
-    queries = []
-    for i in range(queries_count):
-        qname, queries_bytes = read_qname(queries_bytes, body)
-        qtype = int(struct.unpack('!H', queries_bytes[:2])[0])
-        qclass = int(struct.unpack('!H', queries_bytes[2:4])[0])
-        queries_bytes = queries_bytes[4:]
+def bytes2request(data: bytes) -> DnsPackage:
+    view = memoryview(data)
+    header = DnsHeader.from_values(*HEADER.unpack_from(view))
+    names = {}
+    queries, offset = bytes2queries(view, 12, header.qd_count, names)
+    package = DnsPackage(header)
+    package.queries = queries
+    # requests carry no answers, only the OPT record of EDNS0 in the additional section
+    if header.an_count + header.ns_count + header.ar_count > 0:
+        records, _ = bytes2records(view, offset, header.an_count + header.ns_count + header.ar_count,
+                                   names, package.ttl_offsets)
+        package.with_records_from_header(records)
+    return package
+
 
+def bytes2queries(view: memoryview, offset: int, queries_count: int, names: dict):
+    queries = []
+    for _ in range(queries_count):
+        qname, offset = read_qname(view, offset, names)
+        qtype, qclass = QUESTION.unpack_from(view, offset)
+        offset += QUESTION.size
         queries.append(DnsQuery(qname, qtype, qclass))
-    return queries, queries_bytes
+    return queries, offset
 
 
-def read_qname(queries_bytes: bytes, body: bytes):
+def read_qname(view: memoryview, offset: int, names: dict[int, (str, int)] = None):
+    # names caches already decoded name suffixes of the package: offset -> (name, end offset)
+    if names is None:
+        names = {}
     labels = []
-    label_len = queries_bytes[0]
-    queries_bytes = queries_bytes[1:]
-    while label_len > 0:
+    segment = []
+    segments = []
+    suffix = None
+    name_length = 0
+    # compression pointers may only go backwards, so following them always terminates
+    pointer_limit = offset
+    while True:
+        if offset in names:
+            suffix, end = names[offset]
+            name_length += len(suffix) + 1
+            segments.append((segment, end))
+            break
+
+        label_len = view[offset]
+        if label_len & 0b1100_0000 == 0b1100_0000:
+            pointer = (label_len & 0b0011_1111) << 8 | view[offset + 1]
+            if pointer >= pointer_limit:
+                raise DnsParserException(f'Invalid compression pointer {pointer} at {offset}')
+            segments.append((segment, offset + 2))
+            segment = []
+            offset = pointer_limit = pointer
+            continue
         if label_len & 0b1100_0000:
-            ptr = (label_len ^ 0b1100_0000) << 8 | queries_bytes[0]
-            queries_bytes = queries_bytes[1:]
-            domain, _ = read_qname(body[ptr:], body)
-            labels.append(domain)
+            raise DnsParserException(f'Unsupported label type at {offset}')
+        if label_len == 0:
+            segments.append((segment, offset + 1))
             break
-        labels.append(queries_bytes[:label_len].decode())
-        queries_bytes = queries_bytes[label_len:]
-        label_len = queries_bytes[0]
-        queries_bytes = queries_bytes[1:]
-    qname = '.'.join(labels)
-    return qname, queries_bytes
 
+        name_length += label_len + 1
+        if name_length > MAX_NAME_LENGTH:
+            raise DnsParserException('Domain name is too long')
+        segment.append(offset)
+        labels.append(str(view[offset + 1:offset + 1 + label_len], 'utf-8'))
+        offset += label_len + 1
 
-def bytes2records(records_bytes: bytes, body: bytes):
+    if suffix:
+        labels.append(suffix)
+    i = 0
+    for segment, end in segments:
+        for label_offset in segment:
+            names[label_offset] = ('.'.join(labels[i:]), end)
+            i += 1
+    # the same names come in every answer and become cache keys, interning keeps one copy of each
+    return sys.intern('.'.join(labels)), segments[0][1]
+
+
+def bytes2records(view: memoryview, offset: int, records_count: int, names: dict, ttl_offsets: list[int]):
     records = []
-    while len(records_bytes) > 0:
-        record, records_bytes = bytes2record(records_bytes, body)
+    for _ in range(records_count):
+        record, offset = bytes2record(view, offset, names, ttl_offsets)
         records.append(record)
-    return records
+    return records, offset
+
+
+def bytes2record(view: memoryview, offset: int, names: dict, ttl_offsets: list[int]):
+    domain, offset = read_qname(view, offset, names)
+    rtype, rclass, ttl, rdlength = RECORD.unpack_from(view, offset)
+    if rtype != OPT_TYPE:
+        ttl_offsets.append(offset + 4)
+    offset += RECORD.size
+    rdata_end = offset + rdlength
+    if rdata_end > len(view):
+        raise DnsParserException(f'Record data of "{domain}" is out of package')
+
+    rdata = read_rdata(view, offset, rdata_end, rtype, names)
+    record = DnsResourceRecord(domain, rtype, rclass, ttl, len(rdata), rdata)
+    return record, rdata_end
+
 
+def read_rdata(view: memoryview, offset: int, rdata_end: int, rtype: int, names: dict) -> bytes:
+    if rtype in NAME_RDATA_TYPES:
+        name, _ = read_qname(view, offset, names)
+        return qname2bytes(name)
+    if rtype == 15:
+        exchange, _ = read_qname(view, offset + MX_PREFERENCE.size, names)
+        return bytes(view[offset:offset + MX_PREFERENCE.size]) + qname2bytes(exchange)
+    if rtype == 6:
+        mname, offset = read_qname(view, offset, names)
+        rname, offset = read_qname(view, offset, names)
+        return qname2bytes(mname) + qname2bytes(rname) + bytes(view[offset:offset + SOA_NUMBERS_LENGTH])
+    return bytes(view[offset:rdata_end])
 
-def bytes2record(record_bytes: bytes, body: bytes):
-    domain, data = read_qname(record_bytes, body)
-    rtype, rclass, ttl, rdlength, data = struct.unpack(f'!2hIH{len(data) - 10}s', data)
-    rdata, next_record = struct.unpack(f'!{rdlength}s{len(data) - rdlength}s', data)
 
-    record = DnsResourceRecord(domain, rtype, rclass, ttl, rdlength, rdata)
-    return record, next_record
+class DnsParserException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
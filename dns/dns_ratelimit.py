@@ -0,0 +1,79 @@
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+SLIP = 'slip'
+DROP = 'drop'
+POLICIES = (SLIP, DROP)
+DEFAULT_PREFIX = 24
+MAX_CLIENTS = 100000
+# idle buckets removed on every new client, enough to keep up with any arrival rate of new clients
+EVICTIONS_PER_INSERT = 2
+
+
+@dataclass
+class RateLimitOptions:
+    rate: float
+    burst: float | None = None
+    prefix: int = DEFAULT_PREFIX
+    policy: str = SLIP
+
+
+class RateLimiter:
+    # a token bucket per source prefix: `rate` queries per second with bursts up to `burst`.
+    # a bucket is two floats refilled lazily on use, buckets of idle clients are dropped as new ones arrive
+    def __init__(self, rate: float, burst: float | None = None, prefix: int = DEFAULT_PREFIX,
+                 policy: str = SLIP, max_clients: int = MAX_CLIENTS):
+        if rate <= 0:
+            raise RateLimitException('Rate limit must be positive')
+        if policy not in POLICIES:
+            raise RateLimitException(f'Unknown rate limit policy "{policy}"')
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.shift = 32 - min(max(prefix, 0), 32)
+        self.policy = policy
+        self.max_clients = max_clients
+        # a bucket unused this long is full again, the same as a new one
+        self.idle = self.burst / rate
+        # source prefix -> [tokens, last use], the least recently used first
+        self.buckets: OrderedDict[int, list[float]] = OrderedDict()
+
+    def allow(self, host: str) -> bool:
+        now = time.monotonic()
+        key = int.from_bytes(socket.inet_aton(host), 'big') >> self.shift
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.evict(now)
+            self.buckets[key] = [self.burst - 1, now]
+            return True
+
+        self.buckets.move_to_end(key)
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        bucket[1] = now
+        if tokens > self.burst:
+            tokens = self.burst
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def evict(self, now: float):
+        buckets = self.buckets
+        for _ in range(EVICTIONS_PER_INSERT):
+            if len(buckets) == 0:
+                return
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self.idle and len(buckets) < self.max_clients:
+                return
+            del buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class RateLimitException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
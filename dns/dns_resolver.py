@@ -0,0 +1,256 @@
+import random
+import socket
+import time
+from dataclasses import dataclass
+
+from dns_cache import DnsCache
+from dns_models import DnsHeader, DnsPackage, DnsQuery, Edns, dns_query_package, is_truncated
+from dns_models import SOA_TYPE, NOERROR, NXDOMAIN, EDNS_PAYLOAD_SIZE, MAX_PACKAGE_SIZE
+from dns_parser import bytes2package, read_qname
+from dns_tcp import TcpUpstreamPool, TcpException
+from dns_upstream import Upstream, ranked
+
+A_TYPE = 1
+NS_TYPE = 2
+CNAME_TYPE = 5
+ANY_TYPE = 255
+# a.root-servers.net ... m.root-servers.net
+ROOT_HINTS = ['198.41.0.4', '170.247.170.2', '192.33.4.12', '199.7.91.13', '192.203.230.10', '192.5.5.241',
+              '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129', '199.7.83.42',
+              '202.12.27.33']
+NAME_SERVER_TIMEOUT = 2
+SERVERS_PER_STEP = 3
+MAX_REFERRALS = 16
+MAX_CNAME_CHAIN = 8
+# how deep the addresses of name servers without glue are resolved
+MAX_NS_DEPTH = 2
+MAX_KNOWN_SERVERS = 4096
+
+
+def in_zone(name: str, zone: str) -> bool:
+    return zone == '' or name == zone or name.endswith('.' + zone)
+
+
+def rdata_name(rdata: bytes) -> str:
+    name, _ = read_qname(memoryview(rdata), 0)
+    return name.lower()
+
+
+@dataclass
+class ResolverOptions:
+    root_hints: list[str] | None = None
+    ns_port: int = 53
+
+
+class IterativeResolver:
+    # resolves misses itself instead of a forwarder: the walk starts at the deepest zone cut known from the cache
+    # (or at the root hints) and follows referrals down. NS records of every cut and the glue addresses of its
+    # servers go to the same cache, so the next name of a known zone skips the root and tld servers
+    def __init__(self, cache: DnsCache, root_hints: list[tuple[str, int]], tcp_upstreams: TcpUpstreamPool,
+                 port: int = 53, udp_payload_size: int = EDNS_PAYLOAD_SIZE):
+        self.cache = cache
+        self.root_hints = root_hints
+        self.tcp_upstreams = tcp_upstreams
+        self.port = port
+        self.udp_payload_size = udp_payload_size
+        # rtt of every name server ever asked, the fastest server of a zone is asked first
+        self.servers: dict[tuple[str, int], Upstream] = {}
+
+    def resolve(self, query: DnsQuery) -> DnsPackage:
+        steps = self.resolution(query)
+        response_bytes = None
+        try:
+            while True:
+                request_bytes, servers = steps.send(response_bytes)
+                response_bytes = self.ask(request_bytes, servers)
+        except StopIteration as result:
+            return result.value
+
+    async def resolve_async(self, query: DnsQuery, forwarder) -> DnsPackage:
+        steps = self.resolution(query)
+        response_bytes = None
+        try:
+            while True:
+                request_bytes, servers = steps.send(response_bytes)
+                response_bytes = await self.ask_async(request_bytes, servers, forwarder)
+        except StopIteration as result:
+            return result.value
+
+    def ask(self, request_bytes: bytes, servers: list[Upstream]) -> bytes | None:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(NAME_SERVER_TIMEOUT)
+            for server in servers[:SERVERS_PER_STEP]:
+                sent_at = time.monotonic()
+                try:
+                    sock.sendto(request_bytes, server.address)
+                    while True:
+                        response_bytes, address = sock.recvfrom(MAX_PACKAGE_SIZE)
+                        if address == server.address and response_bytes[:2] == request_bytes[:2]:
+                            break
+                    if is_truncated(response_bytes):
+                        response_bytes = self.tcp_upstreams.query(server.address, request_bytes)
+                except (OSError, TcpException):
+                    server.record_failure()
+                    continue
+                server.record_success(time.monotonic() - sent_at)
+                return response_bytes
+        return None
+
+    async def ask_async(self, request_bytes: bytes, servers: list[Upstream], forwarder) -> bytes | None:
+        for server in servers[:SERVERS_PER_STEP]:
+            sent_at = time.monotonic()
+            try:
+                response_bytes = await forwarder.query(request_bytes, server.address, NAME_SERVER_TIMEOUT)
+                if is_truncated(response_bytes):
+                    response_bytes = await self.tcp_upstreams.query_async(server.address, request_bytes)
+            except Exception:
+                server.record_failure()
+                continue
+            server.record_success(time.monotonic() - sent_at)
+            return response_bytes
+        return None
+
+    def resolution(self, query: DnsQuery, depth: int = 0):
+        # the walk yields (request, servers to ask) and gets back the answer or None when no server answered,
+        # so the same steps run over blocking sockets and over asyncio
+        name = query.qname.lower()
+        visited = {name}
+        answers = []
+        zone, servers = self.closest_servers(name, query.qclass)
+        for _ in range(MAX_REFERRALS):
+            response_bytes = yield self.request(DnsQuery(name, query.qtype, query.qclass)), servers
+            if response_bytes is None:
+                raise ResolverException(f'Name servers of "{zone or "."}" do not respond')
+            response = bytes2package(response_bytes)
+            rcode = response.header.rcode
+            if rcode not in (NOERROR, NXDOMAIN):
+                raise ResolverException(f'Name servers of "{zone or "."}" answered with rcode {rcode}')
+
+            target = self.follow_answers(name, query.qtype, response.ans_records, answers)
+            if target is None:
+                return self.result(query, NOERROR, answers, [])
+            if target != name and rcode == NOERROR:
+                # the cname chain leads out of the zone of the server, the rest is looked up from its own cut
+                if target in visited or len(visited) > MAX_CNAME_CHAIN:
+                    raise ResolverException(f'CNAME chain of "{query.qname}" is too long or looped')
+                visited.add(target)
+                name = target
+                zone, servers = self.closest_servers(name, query.qclass)
+                continue
+
+            delegation = self.referral(name, zone, response)
+            if delegation is None:
+                authority = [r for r in response.auth_records if r.rtype == SOA_TYPE]
+                return self.result(query, rcode, answers, authority)
+            zone, ns_names, addresses = delegation
+            if len(addresses) == 0:
+                addresses = yield from self.server_addresses(ns_names, query.qclass, depth)
+            if len(addresses) == 0:
+                raise ResolverException(f'No address is known for name servers of "{zone}"')
+            servers = self.rank(addresses)
+        raise ResolverException(f'Too many referrals for "{query.qname}"')
+
+    def request(self, query: DnsQuery) -> bytes:
+        request = dns_query_package(random.getrandbits(16), [query])
+        request.header.rd = False
+        return request.with_edns(Edns(self.udp_payload_size)).to_bytes()
+
+    def closest_servers(self, name: str, qclass: int) -> (str, list[Upstream]):
+        labels = name.split('.') if name else []
+        for i in range(len(labels) + 1):
+            zone = '.'.join(labels[i:])
+            addresses = self.cut_addresses(zone, qclass)
+            if len(addresses) > 0:
+                return zone, self.rank(addresses)
+        return '', self.rank(self.root_hints)
+
+    def cut_addresses(self, zone: str, qclass: int) -> list[tuple[str, int]]:
+        addresses = []
+        for ns_data, _ in self.cache.get(zone, NS_TYPE, qclass):
+            if len(ns_data) == 0:
+                continue
+            for data, _ in self.cache.get(rdata_name(ns_data), A_TYPE, qclass):
+                if len(data) == 4:
+                    addresses.append((socket.inet_ntoa(data), self.port))
+        return addresses
+
+    def rank(self, addresses: list[tuple[str, int]]) -> list[Upstream]:
+        if len(self.servers) > MAX_KNOWN_SERVERS:
+            self.servers.clear()
+        servers = []
+        for address in dict.fromkeys(addresses):
+            server = self.servers.get(address)
+            if server is None:
+                server = self.servers.setdefault(address, Upstream(address))
+            servers.append(server)
+        return ranked(servers)
+
+    @staticmethod
+    def follow_answers(name: str, qtype: int, records: list, answers: list) -> str | None:
+        # the answer and the cname chain leading to it are appended to answers;
+        # None means the answer is complete, otherwise the name that is still to be resolved is returned
+        for _ in range(MAX_CNAME_CHAIN):
+            matched = [r for r in records if r.name.lower() == name and (r.rtype == qtype or qtype == ANY_TYPE)]
+            if len(matched) > 0:
+                answers.extend(matched)
+                return None
+            cname = next((r for r in records if r.name.lower() == name and r.rtype == CNAME_TYPE), None)
+            if cname is None:
+                return name
+            answers.append(cname)
+            name = rdata_name(cname.rdata)
+        return name
+
+    def referral(self, name: str, zone: str, response: DnsPackage) -> (str, list[str], list[tuple[str, int]]):
+        # a referral carries no answer and the NS records of a cut below the current zone, above the name
+        if response.header.aa or response.header.rcode != NOERROR:
+            return None
+        cut = next((r.name.lower() for r in response.auth_records if r.rtype == NS_TYPE), None)
+        if cut is None or cut == zone or not in_zone(cut, zone) or not in_zone(name, cut):
+            return None
+
+        ns_names = []
+        for r in response.auth_records:
+            if r.rtype == NS_TYPE and r.name.lower() == cut:
+                self.cache.put(cut, NS_TYPE, r.rclass, r.ttl, r.rdata)
+                ns_names.append(rdata_name(r.rdata))
+        addresses = []
+        for r in response.additional_records:
+            glue_name = r.name.lower()
+            # glue is only taken for the listed servers and only from inside the zone of the answering server
+            if r.rtype == A_TYPE and len(r.rdata) == 4 and glue_name in ns_names and in_zone(glue_name, zone):
+                self.cache.put(glue_name, A_TYPE, r.rclass, r.ttl, r.rdata)
+                addresses.append((socket.inet_ntoa(r.rdata), self.port))
+        return cut, ns_names, addresses
+
+    def server_addresses(self, ns_names: list[str], qclass: int, depth: int):
+        # a delegation without glue: the address of one of its servers is resolved by a nested walk
+        if depth >= MAX_NS_DEPTH:
+            return []
+        for ns_name in ns_names[:2]:
+            try:
+                result = yield from self.resolution(DnsQuery(ns_name, A_TYPE, qclass), depth + 1)
+            except ResolverException:
+                continue
+            addresses = []
+            for r in result.ans_records:
+                if r.rtype == A_TYPE and len(r.rdata) == 4:
+                    self.cache.put(ns_name, A_TYPE, r.rclass, r.ttl, r.rdata)
+                    addresses.append((socket.inet_ntoa(r.rdata), self.port))
+            if len(addresses) > 0:
+                return addresses
+        return []
+
+    @staticmethod
+    def result(query: DnsQuery, rcode: int, answers: list, authority: list) -> DnsPackage:
+        header = DnsHeader(0, aa=False, rcode=rcode)
+        return DnsPackage(header).with_queries([query]).with_ans_records(answers).with_auth_records(authority)
+
+    def __str__(self):
+        return 'корневые серверы (итеративный поиск)'
+
+
+class ResolverException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -1,110 +1,497 @@
+import random
+import select
 import socket
+import time
 from multiprocessing import Process
 from multiprocessing.pool import ThreadPool
 from threading import Thread
 
-from dns_cache import DnsCache
+from dns_cache import DnsCache, LOAD_WAIT_TIMEOUT
+from dns_hot_names import HotNames
 from dns_models import DnsPackage, dns_package_with_internal_error, DnsHeader, DnsResourceRecord, DNS_RECORD_TYPES
-from dns_parser import bytes2package
+from dns_models import DnsQuery, Edns, dns_query_package, truncated_package, is_truncated, slip_package
+from dns_models import with_opt, has_opt_at
+from dns_models import question_end, HEADER
+from dns_models import SOA_TYPE, SOA_MINIMUM, OPT_TYPE, NXDOMAIN_TYPE, NOERROR, NXDOMAIN
+from dns_models import UDP_PACKAGE_SIZE, EDNS_PAYLOAD_SIZE, MAX_PACKAGE_SIZE
+from dns_log import QueryLog
+from dns_metrics import Metrics
+from dns_parser import bytes2package, bytes2request
+from dns_ratelimit import RateLimiter, SLIP, DEFAULT_PREFIX
+from dns_resolver import IterativeResolver, ROOT_HINTS
+from dns_tcp import TcpUpstreamPool, TCP_IDLE_TIMEOUT, TCP_BACKLOG, frame, recv_message
+from dns_upstream import UpstreamSet, Upstream, parse_upstream
+from dns_wire_cache import WireCache
+from dns_zone import ZoneSet
 
-
-def _resolve_host(host: str) -> str:
-    try:
-        return socket.gethostbyname(host)
-    except Exception as e:
-        raise DnsCacheServerException(f'Can not resolve host "{host}"', e)
+FORWARDER_TIMEOUT = 5
+MAX_HEDGED_UPSTREAMS = 2
+WARM_UP_PARALLELISM = 16
+# QR and opcode of the header flags, a plain query has them all zero
+NOT_A_QUERY = 0b1111_1000_0000_0000
 
 
 class DnsCacheServer:
-    def __init__(self, host: str, port: int, cache: DnsCache, fw_host: str, fw_port: int = 53):
+    def __init__(self, host: str, port: int, cache: DnsCache, fw_host: str | list[str], fw_port: int = 53,
+                 udp_payload_size: int = EDNS_PAYLOAD_SIZE):
         self.host = host
         self.port = port
-        self.fw_address = (_resolve_host(fw_host), fw_port)
+        fw_hosts = [fw_host] if isinstance(fw_host, str) else fw_host
+        self.upstreams = UpstreamSet([parse_upstream(h, fw_port) for h in fw_hosts])
+        self.tcp_upstreams = TcpUpstreamPool()
+        self.udp_payload_size = max(udp_payload_size, UDP_PACKAGE_SIZE)
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         self.cache: DnsCache = cache
+        self.wire_cache = WireCache(refresh_fraction=cache.refresh_fraction, refresh_hits=cache.refresh_hits)
+        self.cache.on_refresh = self.refresh
+        self.wire_cache.on_refresh = self.refresh
+        self.zones = ZoneSet()
+        self.resolver: IterativeResolver | None = None
+        self.limiter: RateLimiter | None = None
+        self.hot_names = HotNames()
+        self.log = QueryLog()
+        self.metrics = Metrics()
+        self.metrics.gauge('cache_records', lambda: len(self.cache))
+        self.metrics.gauge('cache_memory_bytes', lambda: self.cache.memory)
+        self.metrics.gauge('cache_evictions', lambda: self.cache.evictions)
+        self.metrics.gauge('wire_cache_entries', lambda: len(self.wire_cache.cache))
         self.pool = ThreadPool()
         self.dns_demon = Thread(target=self.run, daemon=True)
+        self.tcp_demon = Thread(target=self.run_tcp, daemon=True)
         self.active = True
 
     def stop_listener(self):
-        while input() != 'stop':
-            pass
+        while (command := input()) != 'stop':
+            if command == 'reload':
+                self.reload_zones()
+        self.stop()
+        print('DNS сервер остановлен')
+
+    def use_zones(self, filenames: list[str], generation=None):
+        self.zones = ZoneSet(filenames)
+        # answers cached before a reload must not hide new local names from the fast path
+        self.zones.on_reload = self.wire_cache.clear
+        self.reload_zones()
+        self.zones.start_watching(generation)
+
+    def use_resolver(self, root_hints: list[str] = None, ns_port: int = 53):
+        # misses are resolved from the root servers instead of the forwarders
+        hints = [parse_upstream(h, ns_port) for h in root_hints or ROOT_HINTS]
+        self.resolver = IterativeResolver(self.cache, hints, self.tcp_upstreams, ns_port, self.udp_payload_size)
+
+    def use_rate_limit(self, rate: float, burst: float | None = None, prefix: int = DEFAULT_PREFIX,
+                       policy: str = SLIP):
+        # only udp is limited: a slipped client retries over tcp, which can not come from a spoofed address
+        self.limiter = RateLimiter(rate, burst, prefix, policy)
+        self.metrics.gauge('ratelimit_clients', lambda: len(self.limiter))
+
+    def reload_zones(self):
+        try:
+            print(f'Загружено {self.zones.reload()} записей локальных зон')
+        except Exception as e:
+            print(f'Не удалось загрузить локальные зоны: {e}')
+
+    def stop(self):
         self.active = False
+        self.tcp_sock.close()
+        self.tcp_upstreams.close()
+        self.log.stop()
         self.dns_demon.join(0)
-        print('DNS сервер остановлен')
 
     def run(self):
+        self.tcp_demon.start()
         print('DNS сервер успешно запущен')
 
         while True:
             if not self.active:
                 break
             try:
-                request_bytes, address = self.server_sock.recvfrom(512)
+                request_bytes, address = self.server_sock.recvfrom(MAX_PACKAGE_SIZE)
+                if self.limiter is not None and not self.limiter.allow(address[0]):
+                    response_bytes = self.shed(request_bytes)
+                    if response_bytes != b'':
+                        self.server_sock.sendto(response_bytes, address)
+                    continue
                 self.start_answer(request_bytes, address)
                 # self.pool.apply_async(self.start_answer, args=(request_bytes, address))
             except:
                 pass
 
+    def run_tcp(self):
+        while self.active:
+            try:
+                connection, address = self.tcp_sock.accept()
+            except OSError:
+                break
+            Thread(target=self.serve_tcp, args=(connection, address), daemon=True).start()
+
+    def serve_tcp(self, connection: socket.socket, address: tuple[str, int]):
+        with connection:
+            connection.settimeout(TCP_IDLE_TIMEOUT)
+            while self.active:
+                try:
+                    request_bytes = recv_message(connection)
+                    connection.sendall(frame(self.answer(request_bytes, address, tcp=True)))
+                except OSError:
+                    break
+                except Exception:
+                    pass
+
     def start(self):
+        self.launch()
+        self.stop_listener()
+
+    def launch(self):
         reverse_host = self.host.split('.')
         reverse_host.reverse()
         arpa_name = '.'.join(reverse_host + ['in-addr.arpa'])
         self.cache.put(arpa_name, 12, 1, 9999, b'Personal cache dns server')
         self.server_sock.bind((self.host, self.port))
+        self.tcp_sock.bind((self.host, self.port))
+        self.tcp_sock.listen(TCP_BACKLOG)
         self.dns_demon.start()
-        self.stop_listener()
+
+    def reuse_port(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise DnsCacheServerException('SO_REUSEPORT is not supported on this platform')
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     def start_answer(self, request_bytes: bytes, address: tuple[str, int]):
-        request = bytes2package(request_bytes)
-        for q in request.queries:
-            print(f'\nЗапрос от {address}: {q.qname} type {DNS_RECORD_TYPES[q.qtype] if q.qtype in DNS_RECORD_TYPES else q.qtype}')
+        self.server_sock.sendto(self.answer(request_bytes, address), address)
+
+    def shed(self, request_bytes: bytes) -> bytes:
+        if self.limiter.policy == SLIP:
+            self.metrics.count('ratelimit_slipped')
+            return slip_package(request_bytes)
+        self.metrics.count('ratelimit_dropped')
+        return b''
+
+    def fast_answer(self, request_bytes: bytes, address: tuple[str, int], tcp: bool) -> bytes | None:
+        # a plain query with one question (and maybe an OPT record) is looked up by its raw question bytes,
+        # without building the package; anything else or a miss goes the full way
+        started = time.perf_counter()
+        if len(request_bytes) < HEADER.size:
+            return None
+        request_id, flags, qd_count, an_count, ns_count, ar_count = HEADER.unpack_from(request_bytes)
+        if flags & NOT_A_QUERY or qd_count != 1 or an_count or ns_count or ar_count > 1:
+            return None
+        end = question_end(request_bytes)
+        if end == 0 or ar_count == 1 and not has_opt_at(request_bytes, end):
+            return None
+        question = request_bytes[HEADER.size:end]
+        self.hot_names.record(question)
+        response_bytes = self.wire_cache.get(question, request_id)
+        if response_bytes is None:
+            return None
+        if ar_count == 1:
+            response_bytes = with_opt(response_bytes, self.udp_payload_size)
+        # an answer longer than plain udp allows needs the EDNS0 payload size, which is not read here
+        if not tcp and len(response_bytes) > UDP_PACKAGE_SIZE:
+            return None
+        self.metrics.query(0.0, time.perf_counter() - started, None, response_bytes, tcp, fast=True)
+        self.log.write(request_id, '\nЗапрос от {}: [{}] найден в кеше без разбора пакета', address, request_id)
+        return response_bytes
+
+    def answer(self, request_bytes: bytes, address: tuple[str, int], tcp: bool = False) -> bytes:
+        dns_response = self.fast_answer(request_bytes, address, tcp)
+        if dns_response is not None:
+            return dns_response
+
+        started = time.perf_counter()
+        request = bytes2request(request_bytes)
+        parsed = time.perf_counter()
+        self.log_request(request, address)
 
         dns_response = self.from_cache(request)
+        cached = time.perf_counter()
+        forwarded = None
         if dns_response == b'':
             dns_response = self.from_forwarder(request, request_bytes)
+            forwarded = time.perf_counter() - cached
+        if not tcp:
+            dns_response = self.fit_udp(request, dns_response)
 
-        self.server_sock.sendto(dns_response, address)
-        print(f'\t[{request.header.id}] Отправлено {address}')
+        self.metrics.query(parsed - started, cached - parsed, forwarded, dns_response, tcp)
+        self.log.write(request.header.id, '\t[{}] Отправлено {}', request.header.id, address)
+        return dns_response
+
+    def fit_udp(self, request: DnsPackage, dns_response: bytes) -> bytes:
+        if len(dns_response) <= min(request.udp_payload_size(), self.udp_payload_size):
+            return dns_response
+        self.metrics.count('truncated')
+        self.log.write(request.header.id, '\t[{}] Ответ не помещается в UDP, клиенту предложен TCP', request.header.id)
+        return truncated_package(dns_response, request.queries, self.response_edns(request))
+
+    def response_edns(self, request: DnsPackage) -> Edns | None:
+        # RFC 6891: a request with OPT gets OPT back; cached answers are kept without it
+        return None if request.edns is None else Edns(self.udp_payload_size)
+
+    def with_edns(self, request: DnsPackage, response_bytes: bytes) -> bytes:
+        if request.edns is None or response_bytes == b'':
+            return response_bytes
+        return with_opt(response_bytes, self.udp_payload_size)
 
     def from_forwarder(self, dns_request: DnsPackage, request_bytes: bytes) -> bytes:
-        print(f'\t[{dns_request.header.id}] Не найдены кешированные записи. Обращение к {self.fw_address}...')
+        self.log.write(dns_request.header.id, '\t[{}] Не найдены кешированные записи. Обращение к {}...',
+                       dns_request.header.id, self.resolver or self.upstreams)
         try:
-            if (self.host, self.port) == self.fw_address:
-                print(f'\t[{dns_request.header.id}] Вышестоящий сервер образует петлю. Запрос отклонён')
-                raise DnsCacheServerException(f'[{dns_request.header.id}] Cyclic DNS request')
+            self.check_forwarder_loop(dns_request)
+            response_bytes, upstream = self.lookup(dns_request, request_bytes)
+            self.log.write(dns_request.header.id, '\t[{}] Получен ответ от {}', dns_request.header.id, upstream)
+            if self.cache_response(response_bytes).edns is None:
+                # an upstream without EDNS0 answered, the client still gets OPT back
+                response_bytes = self.with_edns(dns_request, response_bytes)
+            return response_bytes
+
+        except:
+            self.metrics.count('upstream_failures')
+            self.log.write(dns_request.header.id, '\t[{}] Вышестоящий сервер недоступен', dns_request.header.id)
+            return self.stale_from_cache(dns_request) or \
+                dns_package_with_internal_error(dns_request.header.id, dns_request.queries) \
+                .with_edns(self.response_edns(dns_request)).to_bytes()
+
+    def lookup(self, dns_request: DnsPackage, request_bytes: bytes) -> (bytes, Upstream | IterativeResolver):
+        if self.resolver is not None:
+            return self.resolved(dns_request, self.resolver.resolve(self.single_query(dns_request))), self.resolver
 
-            fw_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            fw_sock.settimeout(5)
-            fw_sock.sendto(request_bytes, self.fw_address)
-            response_bytes, _ = fw_sock.recvfrom(512)
+        response_bytes, upstream = self.exchange(request_bytes)
+        if is_truncated(response_bytes):
+            self.metrics.count('tcp_fallbacks')
+            self.log.write(dns_request.header.id, '\t[{}] Ответ от {} обрезан, повтор запроса по TCP',
+                           dns_request.header.id, upstream)
+            response_bytes = self.tcp_upstreams.query(upstream.address, request_bytes)
+        return response_bytes, upstream
 
-            print(f'\t[{dns_request.header.id}] Получен ответ от {self.fw_address}')
-            dns_response = bytes2package(response_bytes)
+    @staticmethod
+    def single_query(dns_request: DnsPackage) -> DnsQuery:
+        if len(dns_request.queries) != 1:
+            raise DnsCacheServerException('Iterative resolution supports exactly one question')
+        return dns_request.queries[0]
 
-            for r in dns_response.ans_records + dns_response.auth_records + dns_response.additional_records:
+    def resolved(self, dns_request: DnsPackage, response: DnsPackage) -> bytes:
+        self.metrics.count('iterative_lookups')
+        response.header.id = dns_request.header.id
+        response.header.rd = dns_request.header.rd
+        return response.with_edns(self.response_edns(dns_request)).to_bytes()
+
+    def exchange(self, request_bytes: bytes) -> (bytes, Upstream):
+        # the request goes to the best upstream; if it is silent longer than its p95 rtt,
+        # the same request is hedged to the next one and the first answer wins
+        ranked = self.upstreams.ranked()
+        sent: dict[tuple[str, int], (Upstream, float)] = {}
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as fw_sock:
+            started = time.monotonic()
+            deadline = started + FORWARDER_TIMEOUT
+            hedge_at = started + ranked[0].hedge_delay()
+            fw_sock.sendto(request_bytes, ranked[0].address)
+            sent[ranked[0].address] = (ranked[0], started)
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now >= hedge_at:
+                    if len(sent) < min(len(ranked), MAX_HEDGED_UPSTREAMS):
+                        upstream = ranked[len(sent)]
+                        fw_sock.sendto(request_bytes, upstream.address)
+                        sent[upstream.address] = (upstream, now)
+                    # nobody is left to hedge to, only the deadline is waited for
+                    hedge_at = deadline
+
+                readable, _, _ = select.select([fw_sock], [], [], max(min(hedge_at, deadline) - now, 0))
+                if len(readable) == 0:
+                    continue
+                try:
+                    response_bytes, address = fw_sock.recvfrom(MAX_PACKAGE_SIZE)
+                except OSError:
+                    continue
+                if address in sent and response_bytes[:2] == request_bytes[:2]:
+                    received_at = time.monotonic()
+                    for upstream, sent_at in sent.values():
+                        if upstream.address != address:
+                            upstream.record_lost_race(sent_at, received_at, FORWARDER_TIMEOUT)
+                    upstream, sent_at = sent[address]
+                    upstream.record_success(received_at - sent_at)
+                    return response_bytes, upstream
+
+        for upstream, _ in sent.values():
+            upstream.record_failure()
+        raise DnsCacheServerException('Upstream servers do not respond')
+
+    def refresh(self, key: (str, int, int)):
+        if key[1] != NXDOMAIN_TYPE:
+            self.pool.apply_async(self.prefetch, args=(key,))
+
+    def start_warm_up(self, keys: list[(str, int, int)], parallelism: int = WARM_UP_PARALLELISM, ready=None):
+        # the popular names of the previous run are asked again while the server already answers
+        if len(keys) > 0 and parallelism > 0:
+            Thread(target=self.run_warm_up, args=(keys, parallelism, ready), daemon=True).start()
+
+    def run_warm_up(self, keys: list[(str, int, int)], parallelism: int, ready):
+        if ready is not None:
+            ready.wait(LOAD_WAIT_TIMEOUT)
+        started = time.monotonic()
+        # names that came back fresh with the snapshot are not asked again, names of local zones never
+        keys = [key for key in keys if not self.zones.covers(key[0]) and len(self.cache.get(*key)) == 0]
+        self.metrics.count('warm_up_lookups', len(keys))
+        self.warm_up(keys, parallelism)
+        print(f'Кеш прогрет: {len(keys)} популярных имён за {time.monotonic() - started:.1f} с')
+
+    def warm_up(self, keys: list[(str, int, int)], parallelism: int):
+        with ThreadPool(parallelism) as pool:
+            pool.map(self.fetch, keys)
+
+    def prefetch(self, key: (str, int, int)):
+        self.metrics.count('prefetches')
+        self.fetch(key)
+
+    def fetch(self, key: (str, int, int)):
+        request_bytes = self.prefetch_request(key)
+        request_id = int.from_bytes(request_bytes[:2], 'big')
+        self.log.write(request_id, '\tОбновление {} type {} в кеше', key[0], key[1])
+        try:
+            response_bytes, _ = self.lookup(bytes2request(request_bytes), request_bytes)
+            self.cache_response(response_bytes)
+        except Exception:
+            self.refresh_failed(key)
+            self.log.write(request_id, '\tНе удалось обновить {} type {}', key[0], key[1])
+
+    def refresh_failed(self, key: (str, int, int)):
+        self.cache.refresh_failed(key)
+        self.wire_cache.refresh_failed(key)
+
+    def prefetch_request(self, key: (str, int, int)) -> bytes:
+        request = dns_query_package(random.getrandbits(16), [DnsQuery(*key)])
+        return request.with_edns(Edns(self.udp_payload_size)).to_bytes()
+
+    def check_forwarder_loop(self, dns_request: DnsPackage):
+        if (self.host, self.port) in self.upstreams.addresses():
+            self.log.write(dns_request.header.id, '\t[{}] Вышестоящий сервер образует петлю. Запрос отклонён',
+                           dns_request.header.id)
+            raise DnsCacheServerException(f'[{dns_request.header.id}] Cyclic DNS request')
+
+    def cache_response(self, response_bytes: bytes) -> DnsPackage:
+        dns_response = bytes2package(response_bytes)
+        for r in dns_response.ans_records + dns_response.auth_records + dns_response.additional_records:
+            if r.rtype != OPT_TYPE:
                 self.cache.put(r.name, r.rtype, r.rclass, r.ttl, r.rdata)
-            return response_bytes
 
-        except:
-            print(f'\t[{dns_request.header.id}] Вышестоящий сервер недоступен')
-            return dns_package_with_internal_error(dns_request.header.id, dns_request.queries).to_bytes()
+        header = dns_response.header
+        # an answer with OPT is not replayed as is, clients without EDNS0 must not get it;
+        # the next hit is built from the record cache and stored then. names of local zones are not stored
+        # either, the fast path would answer them ahead of the zones
+        if len(dns_response.queries) == 1 and header.rcode == 0 and header.an_count > 0 and not header.tc \
+                and dns_response.edns is None and not self.zones.covers(dns_response.queries[0].qname):
+            q = dns_response.queries[0]
+            self.wire_cache.put(q.qname, q.qtype, q.qclass, response_bytes, dns_response.ttl_offsets)
+        if header.an_count == 0 and header.rcode in (NOERROR, NXDOMAIN) and not header.tc:
+            self.cache_negative(dns_response)
+        return dns_response
+
+    def cache_negative(self, dns_response: DnsPackage):
+        # RFC 2308: a negative answer is cached for min(SOA ttl, SOA minimum) and only together with its SOA
+        soa = next((r for r in dns_response.auth_records if r.rtype == SOA_TYPE), None)
+        if soa is None or len(soa.rdata) < SOA_MINIMUM.size:
+            return
+        minimum, = SOA_MINIMUM.unpack_from(soa.rdata, len(soa.rdata) - SOA_MINIMUM.size)
+        ttl = min(soa.ttl, minimum)
+        for q in dns_response.queries:
+            if dns_response.header.rcode == NXDOMAIN:
+                self.cache.put(q.qname, NXDOMAIN_TYPE, q.qclass, ttl, b'')
+            else:
+                self.cache.put(q.qname, q.qtype, q.qclass, ttl, b'')
+
+    def log_request(self, request: DnsPackage, address: tuple[str, int]):
+        for q in request.queries:
+            self.log.write(request.header.id, '\nЗапрос от {}: {} type {}',
+                           address, q.qname, DNS_RECORD_TYPES.get(q.qtype, q.qtype))
 
     def from_cache(self, dns_request: DnsPackage) -> bytes:
+        return self.with_edns(dns_request, self.cached_answer(dns_request))
+
+    def cached_answer(self, dns_request: DnsPackage) -> bytes:
+        # names of local zones are answered authoritatively and never reach the cache or the upstream
+        response_bytes = self.zones.answer(dns_request)
+        if response_bytes != b'':
+            self.metrics.count('authoritative')
+            self.log.write(dns_request.header.id, '\t[{}] Найдено в локальной зоне', dns_request.header.id)
+            return response_bytes
+
+        if len(dns_request.queries) == 1:
+            response_bytes = self.wire_cache.get(dns_request.queries[0].to_bytes(), dns_request.header.id)
+            if response_bytes is not None:
+                self.log.write(dns_request.header.id, '\t[{}] Найдено в кеше', dns_request.header.id)
+                return response_bytes
+
         ans_records = []
-        for q in dns_request.queries:
-            for data, ttl in self.cache.get(q.qname, q.qtype, q.qclass):
+        cached = self.cache.get_many([(q.qname, q.qtype, q.qclass) for q in dns_request.queries])
+        for q, records in zip(dns_request.queries, cached):
+            for data, ttl in records:
                 if len(data) == 0:
                     continue
                 ans_records.append(DnsResourceRecord(q.qname, q.qtype, q.qclass, ttl, len(data), data))
         if len(ans_records) == 0:
+            if len(dns_request.queries) == 1:
+                return self.negative_from_cache(dns_request, cached[0])
             return b''
-        print(f'\t[{dns_request.header.id}] Найдено в кеше')
+        self.log.write(dns_request.header.id, '\t[{}] Найдено в кеше', dns_request.header.id)
         header = DnsHeader(dns_request.header.id, aa=False)
         response = DnsPackage(header)
         response.with_queries(dns_request.queries).with_ans_records(ans_records)
-        return response.to_bytes()
+        return self.to_wire_cache(dns_request, response)
+
+    def negative_from_cache(self, dns_request: DnsPackage, records: list[(bytes, int)]) -> bytes:
+        q = dns_request.queries[0]
+        rcode = NOERROR
+        if len(records) == 0:
+            records = self.cache.get(q.qname, NXDOMAIN_TYPE, q.qclass)
+            rcode = NXDOMAIN
+        if len(records) == 0:
+            return b''
+        soa = self.soa_from_cache(q.qname, q.qclass, max(ttl for _, ttl in records))
+        if soa is None:
+            return b''
+
+        self.metrics.count('negative_hits')
+        self.log.write(dns_request.header.id, '\t[{}] Найден отрицательный ответ в кеше', dns_request.header.id)
+        header = DnsHeader(dns_request.header.id, aa=False, rcode=rcode)
+        response = DnsPackage(header).with_queries(dns_request.queries).with_auth_records([soa])
+        return self.to_wire_cache(dns_request, response)
+
+    def soa_from_cache(self, qname: str, qclass: int, ttl: int) -> DnsResourceRecord | None:
+        labels = qname.split('.')
+        for i in range(len(labels) + 1):
+            zone = '.'.join(labels[i:])
+            for data, soa_ttl in self.cache.get(zone, SOA_TYPE, qclass):
+                if len(data) > 0:
+                    return DnsResourceRecord(zone, SOA_TYPE, qclass, min(ttl, soa_ttl), len(data), data)
+        return None
+
+    def stale_from_cache(self, dns_request: DnsPackage) -> bytes:
+        ans_records = []
+        for q in dns_request.queries:
+            for data, ttl in self.cache.get_stale(q.qname, q.qtype, q.qclass):
+                if len(data) > 0:
+                    ans_records.append(DnsResourceRecord(q.qname, q.qtype, q.qclass, ttl, len(data), data))
+        if len(ans_records) == 0:
+            return b''
+        self.metrics.count('stale_answers')
+        self.log.write(dns_request.header.id, '\t[{}] Отправлены устаревшие записи из кеша', dns_request.header.id)
+        header = DnsHeader(dns_request.header.id, aa=False)
+        return DnsPackage(header).with_queries(dns_request.queries).with_ans_records(ans_records) \
+            .with_edns(self.response_edns(dns_request)).to_bytes()
+
+    def to_wire_cache(self, dns_request: DnsPackage, response: DnsPackage) -> bytes:
+        started = time.perf_counter()
+        response_bytes, ttl_offsets = response.to_bytes_with_ttl_offsets()
+        self.metrics.observe('encode', time.perf_counter() - started)
+        if len(dns_request.queries) == 1:
+            q = dns_request.queries[0]
+            self.wire_cache.put(q.qname, q.qtype, q.qclass, response_bytes, ttl_offsets)
+        return response_bytes
 
 
 class DnsCacheServerException(Exception):
@@ -0,0 +1,91 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'DNSC'
+VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('!4sH')
+# body length, crc32 of expires and body, expires (seconds since 1970)
+RECORD_HEADER = struct.Struct('!IIQ')
+EXPIRES = struct.Struct('!Q')
+# ttl, type, class, name length
+RECORD_BODY = struct.Struct('!I3H')
+
+# record layout:
+# | body length: 4 | crc32: 4 | expires: 8 | ttl: 4 | type: 2 | class: 2 | name length: 2 | name | data |
+
+
+def encode_record(key: (str, int, int), data: bytes, value: (int, int)) -> bytes:
+    name, rtype, rclass = key
+    cached_time, ttl = value
+    name = name.encode()
+    expires = cached_time + ttl
+    body = RECORD_BODY.pack(ttl, rtype, rclass, len(name)) + name + data
+    crc = zlib.crc32(body, zlib.crc32(EXPIRES.pack(expires)))
+    return RECORD_HEADER.pack(len(body), crc, expires) + body
+
+
+def read_snapshot(filename: str, now: int):
+    # a checkpoint interrupted by a crash leaves a torn record at the end: reading stops at the first record
+    # that is incomplete or fails its checksum, and the rest of the file is cut off, so the next checkpoint
+    # is appended right after the last good record instead of after the garbage. the cut goes through the open
+    # descriptor: a file saved under the same name meanwhile is another file and stays as it is
+    with open(filename, 'r+b') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < SNAPSHOT_HEADER.size:
+            raise SnapshotException(f'Snapshot "{filename}" is empty')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            magic, version = SNAPSHOT_HEADER.unpack_from(view)
+            if magic != MAGIC or version != VERSION:
+                raise SnapshotException(f'"{filename}" is not a dns cache snapshot')
+
+            offset = SNAPSHOT_HEADER.size
+            while offset + RECORD_HEADER.size <= size:
+                body_length, crc, expires = RECORD_HEADER.unpack_from(view, offset)
+                body = offset + RECORD_HEADER.size
+                end = body + body_length
+                if body_length < RECORD_BODY.size or end > size:
+                    break
+                if zlib.crc32(view[body:end], zlib.crc32(view[offset + 8:body])) != crc:
+                    break
+                offset = end
+                if expires <= now:
+                    continue
+
+                ttl, rtype, rclass, name_length = RECORD_BODY.unpack_from(view, body)
+                name = body + RECORD_BODY.size
+                data = name + name_length
+                key = (sys.intern(str(view[name:data], 'utf-8')), rtype, rclass)
+                yield key, view[data:end], (expires - ttl, ttl)
+
+        if offset < size:
+            os.ftruncate(file.fileno(), offset)
+
+
+def write_snapshot(filename: str, records):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        file.write(SNAPSHOT_HEADER.pack(MAGIC, VERSION))
+        for key, data, value in records:
+            file.write(encode_record(key, data, value))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+
+
+def append_snapshot(filename: str, records):
+    if not os.path.exists(filename):
+        write_snapshot(filename, records)
+        return
+    with open(filename, 'ab') as file:
+        file.write(b''.join(encode_record(key, data, value) for key, data, value in records))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class SnapshotException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -0,0 +1,202 @@
+import asyncio
+import random
+import socket
+import struct
+from threading import Thread, RLock, Event
+
+MESSAGE_LENGTH = struct.Struct('!H')
+TCP_TIMEOUT = 5
+# RFC 7766 recommends closing idle client connections after some seconds
+TCP_IDLE_TIMEOUT = 10
+TCP_BACKLOG = 128
+MAX_PIPELINED = 0x10000
+
+
+def frame(message: bytes) -> bytes:
+    return MESSAGE_LENGTH.pack(len(message)) + message
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError('Connection closed by peer')
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock: socket.socket) -> bytes:
+    length, = MESSAGE_LENGTH.unpack(recv_exactly(sock, MESSAGE_LENGTH.size))
+    return recv_exactly(sock, length)
+
+
+async def read_message(reader: asyncio.StreamReader) -> bytes:
+    length, = MESSAGE_LENGTH.unpack(await reader.readexactly(MESSAGE_LENGTH.size))
+    return await reader.readexactly(length)
+
+
+def _free_id(waiters: dict) -> int:
+    if len(waiters) >= MAX_PIPELINED:
+        raise TcpException('Too many pipelined requests')
+    while True:
+        upstream_id = random.getrandbits(16)
+        if upstream_id not in waiters:
+            return upstream_id
+
+
+class TcpUpstreamConnection:
+    # one persistent connection to the upstream shared by all threads: requests are pipelined
+    # and answers are matched back by id, so they may come in any order (RFC 7766)
+    def __init__(self, address: tuple[str, int]):
+        self.address = address
+        self.sock: socket.socket | None = None
+        self.locker = RLock()
+        # upstream id -> [event, response or None if the connection is lost]
+        self.waiters: dict[int, list] = {}
+
+    def query(self, request_bytes: bytes, timeout: float = TCP_TIMEOUT) -> bytes:
+        waiter = [Event(), None]
+        with self.locker:
+            sock = self.connect()
+            upstream_id = _free_id(self.waiters)
+            self.waiters[upstream_id] = waiter
+            try:
+                sock.sendall(frame(upstream_id.to_bytes(2, 'big') + request_bytes[2:]))
+            except OSError:
+                self.drop(sock)
+                raise
+        try:
+            if not waiter[0].wait(timeout):
+                raise TcpException(f'No answer from {self.address[0]}:{self.address[1]} over tcp')
+        finally:
+            with self.locker:
+                self.waiters.pop(upstream_id, None)
+        if waiter[1] is None:
+            raise TcpException(f'Connection to {self.address[0]}:{self.address[1]} is lost')
+        return request_bytes[:2] + waiter[1][2:]
+
+    def connect(self) -> socket.socket:
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, TCP_TIMEOUT)
+            self.sock.settimeout(None)
+            Thread(target=self.read, args=(self.sock,), daemon=True).start()
+        return self.sock
+
+    def read(self, sock: socket.socket):
+        try:
+            while True:
+                response_bytes = recv_message(sock)
+                if len(response_bytes) < 12:
+                    continue
+                with self.locker:
+                    waiter = self.waiters.pop(int.from_bytes(response_bytes[:2], 'big'), None)
+                if waiter is not None:
+                    waiter[1] = response_bytes
+                    waiter[0].set()
+        except OSError:
+            pass
+        finally:
+            self.drop(sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.drop(self.sock)
+
+    def drop(self, sock: socket.socket):
+        with self.locker:
+            if self.sock is not sock:
+                return
+            # the upstream closes idle connections, everything still waiting is failed and the next query reconnects
+            self.sock = None
+            for waiter in self.waiters.values():
+                waiter[0].set()
+            self.waiters.clear()
+        sock.close()
+
+
+class AsyncTcpUpstreamConnection:
+    def __init__(self, address: tuple[str, int]):
+        self.address = address
+        self.writer: asyncio.StreamWriter | None = None
+        self.connecting: asyncio.Lock | None = None
+        self.waiters: dict[int, asyncio.Future] = {}
+
+    async def query(self, request_bytes: bytes, timeout: float = TCP_TIMEOUT) -> bytes:
+        writer = await self.connect()
+        upstream_id = _free_id(self.waiters)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[upstream_id] = waiter
+        try:
+            writer.write(frame(upstream_id.to_bytes(2, 'big') + request_bytes[2:]))
+            response_bytes = await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.waiters.pop(upstream_id, None)
+        return request_bytes[:2] + response_bytes[2:]
+
+    async def connect(self) -> asyncio.StreamWriter:
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.writer is None or self.writer.is_closing():
+                reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), TCP_TIMEOUT)
+                asyncio.get_running_loop().create_task(self.read(reader, self.writer))
+            return self.writer
+
+    async def read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                response_bytes = await read_message(reader)
+                if len(response_bytes) < 12:
+                    continue
+                waiter = self.waiters.pop(int.from_bytes(response_bytes[:2], 'big'), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(response_bytes)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+                for waiter in self.waiters.values():
+                    if not waiter.done():
+                        waiter.set_exception(TcpException(f'Connection to {self.address[0]}:{self.address[1]} is lost'))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class TcpUpstreamPool:
+    def __init__(self, connection_type: type = TcpUpstreamConnection):
+        self.connection_type = connection_type
+        self.connections: dict[tuple[str, int], TcpUpstreamConnection | AsyncTcpUpstreamConnection] = {}
+
+    def connection(self, address: tuple[str, int]):
+        connection = self.connections.get(address)
+        if connection is None:
+            connection = self.connections.setdefault(address, self.connection_type(address))
+        return connection
+
+    def query(self, address: tuple[str, int], request_bytes: bytes) -> bytes:
+        try:
+            return self.connection(address).query(request_bytes)
+        except TcpException:
+            # the pooled connection may have just been closed by the upstream, one retry gets a fresh one
+            return self.connection(address).query(request_bytes)
+
+    async def query_async(self, address: tuple[str, int], request_bytes: bytes) -> bytes:
+        try:
+            return await self.connection(address).query(request_bytes)
+        except TcpException:
+            return await self.connection(address).query(request_bytes)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+
+class TcpException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -0,0 +1,105 @@
+import socket
+import time
+from collections import deque
+
+INITIAL_HEDGE_DELAY = 0.2
+RTT_SAMPLES = 64
+MAX_FAILURES = 3
+RETRY_UNHEALTHY_AFTER = 30
+
+
+def _resolve_host(host: str) -> str:
+    try:
+        return socket.gethostbyname(host)
+    except Exception as e:
+        raise UpstreamException(f'Can not resolve host "{host}"', e)
+
+
+def parse_upstream(upstream: str, default_port: int = 53) -> tuple[str, int]:
+    host, _, port = upstream.rpartition(':')
+    if host == '' or not port.isdigit():
+        return _resolve_host(upstream), default_port
+    return _resolve_host(host), int(port)
+
+
+class Upstream:
+    def __init__(self, address: tuple[str, int]):
+        self.address = address
+        # smoothed rtt and its variation as in RFC 6298, seconds
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        self.samples: deque[float] = deque(maxlen=RTT_SAMPLES)
+        self.failures = 0
+        self.last_failure = 0.0
+        # send time of the first query lost to another upstream since the last answer of this one
+        self.unanswered_since: float | None = None
+
+    def record_success(self, rtt: float):
+        self.record_rtt(rtt)
+        self.failures = 0
+        self.unanswered_since = None
+
+    def record_lost_race(self, sent_at: float, now: float, timeout: float):
+        # the answer is not awaited when another upstream wins, the time waited is only a lower bound of the rtt:
+        # it may raise srtt, but it is not a sample of the p95. an upstream that keeps losing without a single
+        # answer for longer than the forwarder timeout is counted as failed, as if it had been waited for
+        elapsed = now - sent_at
+        if self.srtt is None or elapsed > self.srtt:
+            self.srtt = elapsed
+        if self.unanswered_since is None:
+            self.unanswered_since = sent_at
+        elif now - self.unanswered_since >= timeout:
+            self.record_failure()
+            self.unanswered_since = None
+
+    def record_rtt(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples.append(rtt)
+
+    def record_failure(self):
+        self.failures += 1
+        self.last_failure = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        return self.failures < MAX_FAILURES or time.monotonic() - self.last_failure > RETRY_UNHEALTHY_AFTER
+
+    def hedge_delay(self) -> float:
+        if len(self.samples) == 0:
+            return INITIAL_HEDGE_DELAY
+        samples = sorted(self.samples)
+        return samples[int(len(samples) * 0.95) if len(samples) > 1 else 0]
+
+    def __str__(self):
+        return f'{self.address[0]}:{self.address[1]}'
+
+
+def ranked(upstreams: list[Upstream]) -> list[Upstream]:
+    # healthy ones first, the fastest of them first; an upstream without samples is tried early to measure it
+    return sorted(upstreams, key=lambda u: (not u.is_healthy(), u.srtt or 0.0, u.failures))
+
+
+class UpstreamSet:
+    def __init__(self, addresses: list[tuple[str, int]]):
+        if len(addresses) == 0:
+            raise UpstreamException('At least one upstream server is required')
+        self.upstreams = [Upstream(address) for address in addresses]
+
+    def addresses(self) -> list[tuple[str, int]]:
+        return [upstream.address for upstream in self.upstreams]
+
+    def ranked(self) -> list[Upstream]:
+        return ranked(self.upstreams)
+
+    def __str__(self):
+        return ', '.join(str(upstream) for upstream in self.upstreams)
+
+
+class UpstreamException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -0,0 +1,89 @@
+import struct
+from threading import Lock
+from typing import Callable
+
+from dns_cache import seconds_now, REFRESH_HITS, REFRESH_FRACTION
+from dns_models import HEADER, QUESTION, qname2bytes, question_key
+
+RESPONSE_ID = struct.Struct('!H')
+TTL = struct.Struct('!I')
+
+
+class WireCache:
+    def __init__(self, max_entries: int = 10000, refresh_fraction: float = REFRESH_FRACTION,
+                 refresh_hits: int = REFRESH_HITS):
+        self.max_entries = max_entries
+        # the same prefetch thresholds as of the record cache
+        self.refresh_fraction = refresh_fraction
+        self.refresh_hits = refresh_hits
+        self.locker = Lock()
+        self.cache: dict[bytes, list] = {}
+        # {
+        #     question_key: [
+        #         package bytes,
+        #         ((ttl offset, ttl), ...),
+        #         cached_time: seconds since 1970,
+        #         expires: seconds since 1970,
+        #         refresh_at: seconds since 1970, moved to expires while a refresh is running,
+        #         hits,
+        #         (name, type, class) to refresh
+        #     ]
+        # }
+        self.on_refresh: Callable[[(str, int, int)], None] | None = None
+
+    def get(self, question: bytes, response_id: int) -> bytes | None:
+        # question is the one of the client, with its own letter case; it replaces the stored one of the same length
+        key = question_key(question)
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        package, ttls, cached_time, expires, refresh_at, hits, refresh_key = entry
+        now = seconds_now()
+        if now >= expires:
+            with self.locker:
+                if self.cache.get(key) is entry:
+                    del self.cache[key]
+            return None
+        entry[5] = hits + 1
+        if now >= refresh_at and hits + 1 >= self.refresh_hits and self.on_refresh is not None:
+            entry[4] = expires
+            self.on_refresh(refresh_key)
+
+        response = bytearray(package)
+        RESPONSE_ID.pack_into(response, 0, response_id)
+        response[HEADER.size:HEADER.size + len(question)] = question
+        elapsed = now - cached_time
+        if elapsed > 0:
+            for offset, ttl in ttls:
+                TTL.pack_into(response, offset, ttl - elapsed)
+        return bytes(response)
+
+    def put(self, qname: str, qtype: int, qclass: int, package: bytes, ttl_offsets: list[int]):
+        if self.max_entries <= 0:
+            return
+        ttls = tuple((offset, TTL.unpack_from(package, offset)[0]) for offset in ttl_offsets)
+        if len(ttls) == 0:
+            return
+        now = seconds_now()
+        min_ttl = min(ttl for _, ttl in ttls)
+        if min_ttl <= 0:
+            return
+        expires = now + min_ttl
+        refresh_at = expires - int(min_ttl * self.refresh_fraction)
+        key = question_key(qname2bytes(qname) + QUESTION.pack(qtype, qclass))
+        with self.locker:
+            self.cache.pop(key, None)
+            while len(self.cache) >= self.max_entries:
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = [package, ttls, now, expires, refresh_at, 0, (qname, qtype, qclass)]
+
+    def refresh_failed(self, key: (str, int, int)):
+        # the entry may be refreshed again, after as many hits as the first time
+        entry = self.cache.get(question_key(qname2bytes(key[0]) + QUESTION.pack(key[1], key[2])))
+        if entry is not None:
+            entry[4] = 0
+            entry[5] = 0
+
+    def clear(self):
+        with self.locker:
+            self.cache.clear()
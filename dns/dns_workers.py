@@ -0,0 +1,99 @@
+from dataclasses import replace
+from multiprocessing import Process, Queue, Event, Value
+from queue import Empty
+from threading import Thread
+
+from dns_cache import DnsCache
+from dns_hot_names import HotNames
+from dns_metrics import TelemetryOptions
+from dns_models import EDNS_PAYLOAD_SIZE
+from dns_ratelimit import RateLimitOptions
+from dns_resolver import ResolverOptions
+from dns_server import DnsCacheServer
+
+WORKER_STOP_TIMEOUT = 10
+
+
+def _worker(engine: type[DnsCacheServer], host: str, port: int, cache: dict, max_memory: int | None,
+            stale_window: int, refresh: (float, int), fw_host: str | list[str], fw_port: int, udp_payload_size: int,
+            telemetry: TelemetryOptions, index: int, zone_files: list[str], zones_generation: Value,
+            iterative: ResolverOptions | None, rate_limit: RateLimitOptions | None,
+            warm_up_keys: list[(str, int, int)], warm_up: int, stop_event: Event, results: Queue):
+    server = engine(host, port, DnsCache(cache, max_memory, stale_window=stale_window, refresh_fraction=refresh[0],
+                                         refresh_hits=refresh[1]), fw_host, fw_port, udp_payload_size)
+    exporter = telemetry.attach(server, index)
+    if len(zone_files) > 0:
+        server.use_zones(zone_files, zones_generation)
+    if iterative is not None:
+        server.use_resolver(iterative.root_hints, iterative.ns_port)
+    if rate_limit is not None:
+        # the pool gives every worker its share of the limit, see DnsWorkerPool
+        server.use_rate_limit(rate_limit.rate, rate_limit.burst, rate_limit.prefix, rate_limit.policy)
+    Thread(target=server.cache.run_expiry, daemon=True).start()
+    server.reuse_port()
+    server.launch()
+    # every worker has its own cache and warms it up itself
+    server.start_warm_up(warm_up_keys, warm_up)
+    stop_event.wait()
+    server.stop()
+    exporter.stop()
+    results.put((server.cache.evictions, server.cache.to_dict(), server.hot_names.to_dict()))
+
+
+class DnsWorkerPool:
+    def __init__(self, engine: type[DnsCacheServer], workers: int, host: str, port: int, cache: DnsCache,
+                 fw_host: str | list[str], fw_port: int = 53, udp_payload_size: int = EDNS_PAYLOAD_SIZE,
+                 telemetry: TelemetryOptions = TelemetryOptions(), zone_files: list[str] = None,
+                 iterative: ResolverOptions | None = None, rate_limit: RateLimitOptions | None = None,
+                 hot_names: HotNames | None = None, warm_up_keys: list[(str, int, int)] = None,
+                 warm_up: int = 0):
+        self.cache = cache
+        self.hot_names = hot_names
+        self.stop_event = Event()
+        self.results = Queue()
+        # every worker watches it and reloads its zones when the number changes
+        self.zones_generation = Value('i', 0)
+        # every worker keeps its own cache, so the memory budget is split between them
+        max_memory = None if cache.max_memory is None else cache.max_memory // workers
+        # the kernel spreads one client over all workers by its source port and every worker keeps its own
+        # buckets, so each of them allows its share of the rate and the burst
+        if rate_limit is not None:
+            rate_limit = replace(rate_limit, rate=rate_limit.rate / workers,
+                                 burst=None if rate_limit.burst is None else rate_limit.burst / workers)
+        self.workers = [Process(target=_worker, daemon=True,
+                                args=(engine, host, port, cache.to_dict(), max_memory, cache.stale_window,
+                                      (cache.refresh_fraction, cache.refresh_hits),
+                                      fw_host, fw_port, udp_payload_size, telemetry, index,
+                                      zone_files or [], self.zones_generation, iterative, rate_limit,
+                                      warm_up_keys or [], warm_up,
+                                      self.stop_event, self.results))
+                        for index in range(workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        print(f'Запущено {len(self.workers)} обработчиков DNS запросов')
+        self.stop_listener()
+
+    def stop_listener(self):
+        while (command := input()) != 'stop':
+            if command == 'reload':
+                with self.zones_generation.get_lock():
+                    self.zones_generation.value += 1
+                print('Обработчики перезагрузят локальные зоны в течение нескольких секунд')
+        self.stop()
+        print('DNS сервер остановлен')
+
+    def stop(self):
+        self.stop_event.set()
+        for _ in self.workers:
+            try:
+                evictions, cache, hot_names = self.results.get(timeout=WORKER_STOP_TIMEOUT)
+                self.cache.merge(cache, evictions)
+                if self.hot_names is not None:
+                    self.hot_names.merge(hot_names)
+            except Empty:
+                print('Не удалось получить кеш от обработчика')
+                break
+        for worker in self.workers:
+            worker.join(WORKER_STOP_TIMEOUT)
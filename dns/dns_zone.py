@@ -0,0 +1,358 @@
+import ipaddress
+import os
+import re
+import struct
+import sys
+import time
+from threading import Thread
+from typing import Callable
+
+from dns_models import DnsHeader, DnsPackage, DnsResourceRecord, qname2bytes, NOERROR, NXDOMAIN
+from dns_parser import read_qname
+
+A_TYPE = 1
+NS_TYPE = 2
+CNAME_TYPE = 5
+SOA_TYPE = 6
+PTR_TYPE = 12
+MX_TYPE = 15
+TXT_TYPE = 16
+AAAA_TYPE = 28
+ZONE_RECORD_TYPES = {'A': A_TYPE, 'NS': NS_TYPE, 'CNAME': CNAME_TYPE, 'SOA': SOA_TYPE, 'PTR': PTR_TYPE,
+                     'MX': MX_TYPE, 'TXT': TXT_TYPE, 'AAAA': AAAA_TYPE}
+CLASSES = {'IN': 1, 'CH': 3, 'HS': 4}
+DEFAULT_TTL = 3600
+MAX_CNAME_CHAIN = 8
+ZONE_CHECK_INTERVAL = 5
+SOA_NUMBERS = struct.Struct('!5I')
+MX_PREFERENCE = struct.Struct('!H')
+# a quoted string (with escapes) or any run of non-space characters
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s"]+')
+
+
+class _Zone:
+    __slots__ = ('origin', 'soa')
+
+    def __init__(self, origin: str):
+        self.origin = origin
+        self.soa: DnsResourceRecord | None = None
+
+    def negative_soa(self) -> list[DnsResourceRecord]:
+        # RFC 2308: the SOA of a negative answer lives for min(SOA ttl, SOA minimum)
+        if self.soa is None:
+            return []
+        minimum = SOA_NUMBERS.unpack_from(self.soa.rdata, len(self.soa.rdata) - SOA_NUMBERS.size)[4]
+        return [DnsResourceRecord(self.soa.name, SOA_TYPE, self.soa.rclass, min(self.soa.ttl, minimum),
+                                  self.soa.rd_length, self.soa.rdata)]
+
+
+class _ZoneNode:
+    # one label of the trie; names are stored from the root label down, so "www.example.com" is com -> example -> www
+    __slots__ = ('children', 'records', 'cname', 'apex')
+
+    def __init__(self):
+        self.children: dict[str, _ZoneNode] = {}
+        # type -> [(ttl, class, rdata), ...]
+        self.records: dict[int, list[(int, int, bytes)]] = {}
+        self.cname: str | None = None
+        self.apex: _Zone | None = None
+
+
+class ZoneSet:
+    def __init__(self, filenames: list[str] = None, referrals: bool = False):
+        self.filenames = filenames or []
+        # an authoritative server answers below a zone cut with a referral; a recursive server
+        # must not hand referrals to stub clients, it leaves such names to its forwarder or resolver
+        self.referrals = referrals
+        self.root = _ZoneNode()
+        self.mtimes: dict[str, float] = {}
+        self.on_reload: Callable[[], None] | None = None
+
+    def reload(self) -> int:
+        # the new trie is built aside and swapped in at once, requests never see a half loaded zone
+        root = _ZoneNode()
+        mtimes = {}
+        records = 0
+        for filename in self.filenames:
+            mtimes[filename] = os.path.getmtime(filename)
+            records += load_zone(root, filename)
+        self.root = root
+        self.mtimes = mtimes
+        if self.on_reload is not None:
+            self.on_reload()
+        return records
+
+    def changed(self) -> bool:
+        try:
+            return any(os.path.getmtime(filename) != self.mtimes.get(filename) for filename in self.filenames)
+        except OSError:
+            return False
+
+    def watch(self, interval: float = ZONE_CHECK_INTERVAL, generation=None):
+        # zone files are re-read when they change on disk or when the shared generation counter is increased
+        known_generation = None if generation is None else generation.value
+        while True:
+            time.sleep(interval)
+            requested = generation is not None and generation.value != known_generation
+            if not requested and not self.changed():
+                continue
+            if generation is not None:
+                known_generation = generation.value
+            try:
+                print(f'Зоны перезагружены: {self.reload()} записей')
+            except Exception as e:
+                print(f'Не удалось перезагрузить зоны: {e}')
+
+    def start_watching(self, generation=None):
+        if len(self.filenames) > 0:
+            Thread(target=self.watch, kwargs={'generation': generation}, daemon=True).start()
+
+    def find(self, qname: str) -> (_Zone | None, _ZoneNode | None):
+        node = self.root
+        zone = node.apex
+        for label in reversed(qname.lower().rstrip('.').split('.')):
+            child = node.children.get(label)
+            if child is None:
+                # RFC 4592: a wildcard is only used below the closest existing ancestor of the name
+                return zone, node.children.get('*')
+            node = child
+            if node.apex is not None:
+                zone = node.apex
+        return zone, node
+
+    def covers(self, qname: str) -> bool:
+        # the name is answered from the local zones, the cache must not answer it ahead of them
+        if len(self.root.children) == 0:
+            return False
+        zone, _ = self.find(qname)
+        return zone is not None and self.delegation(qname)[0] is None
+
+    def node(self, name: str) -> _ZoneNode | None:
+        node = self.root
+        for label in reversed(name.lower().rstrip('.').split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def delegation(self, qname: str) -> (str | None, _ZoneNode | None):
+        # NS records below a zone apex mark a zone cut, the names under it belong to other servers (RFC 1034 4.3.2)
+        labels = qname.lower().rstrip('.').split('.')
+        node = self.root
+        inside = node.apex is not None
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.children.get(labels[i])
+            if node is None:
+                break
+            if node.apex is not None:
+                inside = True
+            elif inside and NS_TYPE in node.records:
+                return '.'.join(labels[i:]), node
+        return None, None
+
+    def answer(self, request: DnsPackage) -> bytes:
+        if len(self.root.children) == 0 or len(request.queries) != 1:
+            return b''
+        query = request.queries[0]
+        zone, node = self.find(query.qname)
+        if zone is None:
+            return b''
+        cut, cut_node = self.delegation(query.qname)
+        if cut is not None:
+            return self.referral(request, cut, cut_node) if self.referrals else b''
+
+        answers = []
+        authority = []
+        rcode = NOERROR
+        name = query.qname
+        visited = {name.lower()}
+        while True:
+            if node is None:
+                rcode = NXDOMAIN
+                authority = zone.negative_soa()
+                break
+            records = node.records.get(query.qtype)
+            if records is not None:
+                answers.extend(DnsResourceRecord(name, query.qtype, rclass, ttl, len(rdata), rdata)
+                               for ttl, rclass, rdata in records)
+                break
+            if node.cname is None or query.qtype == CNAME_TYPE:
+                authority = zone.negative_soa()
+                break
+
+            ttl, rclass, rdata = node.records[CNAME_TYPE][0]
+            answers.append(DnsResourceRecord(name, CNAME_TYPE, rclass, ttl, len(rdata), rdata))
+            # the chain is followed while it stays in local zones, the client resolves the rest itself
+            name = node.cname
+            if name in visited or len(visited) > MAX_CNAME_CHAIN:
+                break
+            visited.add(name)
+            zone, node = self.find(name)
+            if zone is None or self.delegation(name)[0] is not None:
+                break
+
+        header = DnsHeader(request.header.id, aa=True, rd=request.header.rd, rcode=rcode)
+        return DnsPackage(header).with_queries(request.queries).with_ans_records(answers) \
+            .with_auth_records(authority).to_bytes()
+
+    def referral(self, request: DnsPackage, cut: str, node: _ZoneNode) -> bytes:
+        # not authoritative below the cut: the NS records go to the authority section and the addresses
+        # of the servers that are known here go to the additional section as glue
+        authority = [DnsResourceRecord(cut, NS_TYPE, rclass, ttl, len(rdata), rdata)
+                     for ttl, rclass, rdata in node.records[NS_TYPE]]
+        glue = []
+        for ns in authority:
+            ns_name, _ = read_qname(memoryview(ns.rdata), 0)
+            ns_node = self.node(ns_name)
+            if ns_node is None:
+                continue
+            for rtype in (A_TYPE, AAAA_TYPE):
+                glue.extend(DnsResourceRecord(ns_name, rtype, rclass, ttl, len(rdata), rdata)
+                            for ttl, rclass, rdata in ns_node.records.get(rtype, []))
+
+        header = DnsHeader(request.header.id, aa=False, rd=request.header.rd)
+        return DnsPackage(header).with_queries(request.queries).with_auth_records(authority) \
+            .with_additional_records(glue).to_bytes()
+
+
+def load_zone(root: _ZoneNode, filename: str) -> int:
+    # RFC 1035 master file: $ORIGIN, $TTL, @, relative names, omitted owners and ( ) continuation lines.
+    # Without $ORIGIN the file name is the origin, e.g. "example.com.zone".
+    # The zone apex is the owner of the SOA record, or the origin when the file has no SOA
+    origin = os.path.basename(filename).removesuffix('.zone').rstrip('.').lower()
+    apex = origin
+    default_ttl = DEFAULT_TTL
+    owner = None
+    soa = None
+    records = 0
+    with open(filename, encoding='utf-8') as file:
+        for line_number, tokens, owner_omitted in _zone_lines(file):
+            try:
+                if tokens[0].upper() == '$ORIGIN':
+                    origin = _absolute_name(tokens[1], origin)
+                    continue
+                if tokens[0].upper() == '$TTL':
+                    default_ttl = int(tokens[1])
+                    continue
+                if tokens[0].startswith('$'):
+                    raise ZoneException(f'Unsupported directive {tokens[0]}')
+
+                if not owner_omitted:
+                    owner = _absolute_name(tokens[0], origin)
+                    tokens = tokens[1:]
+                if owner is None:
+                    raise ZoneException('Record without owner')
+
+                ttl, rclass, rtype, rdata_tokens = _split_record(tokens, default_ttl)
+                rdata, cname = _encode_rdata(rtype, rdata_tokens, origin)
+                node = _node(root, owner)
+                node.records.setdefault(rtype, []).append((ttl, rclass, rdata))
+                if rtype == CNAME_TYPE:
+                    node.cname = cname
+                if rtype == SOA_TYPE:
+                    if soa is not None:
+                        raise ZoneException('Only one SOA record is allowed in a zone file')
+                    apex = owner
+                    soa = DnsResourceRecord(owner, SOA_TYPE, rclass, ttl, len(rdata), rdata)
+                records += 1
+            except ZoneException as e:
+                raise ZoneException(f'{filename}:{line_number}: {e.msg}')
+            except (ValueError, IndexError, KeyError) as e:
+                raise ZoneException(f'{filename}:{line_number}: invalid record', e)
+
+    zone = _Zone(apex)
+    zone.soa = soa
+    _node(root, apex).apex = zone
+    return records
+
+
+def _zone_lines(file):
+    buffered = []
+    start = 0
+    depth = 0
+    owner_omitted = False
+    for line_number, line in enumerate(file, 1):
+        if depth == 0:
+            start = line_number
+            owner_omitted = line[:1] in (' ', '\t')
+        for token in TOKEN.findall(_strip_comment(line)):
+            if not token.startswith('"'):
+                depth += token.count('(') - token.count(')')
+                token = token.strip('()')
+            if token != '':
+                buffered.append(token)
+        if depth == 0 and len(buffered) > 0:
+            yield start, buffered, owner_omitted
+            buffered = []
+
+
+def _strip_comment(line: str) -> str:
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"' and (i == 0 or line[i - 1] != '\\'):
+            quoted = not quoted
+        elif char == ';' and not quoted:
+            return line[:i]
+    return line
+
+
+def _split_record(tokens: list[str], default_ttl: int) -> (int, int, int, list[str]):
+    # ttl and class are optional and may come in either order before the type
+    ttl = default_ttl
+    rclass = CLASSES['IN']
+    for i, token in enumerate(tokens):
+        if token.isdigit():
+            ttl = int(token)
+        elif token.upper() in CLASSES:
+            rclass = CLASSES[token.upper()]
+        elif token.upper() in ZONE_RECORD_TYPES:
+            return ttl, rclass, ZONE_RECORD_TYPES[token.upper()], tokens[i + 1:]
+        else:
+            raise ZoneException(f'Unsupported record type {token}')
+    raise ZoneException('Record type is missing')
+
+
+def _encode_rdata(rtype: int, tokens: list[str], origin: str) -> (bytes, str | None):
+    if rtype == A_TYPE:
+        return ipaddress.IPv4Address(tokens[0]).packed, None
+    if rtype == AAAA_TYPE:
+        return ipaddress.IPv6Address(tokens[0]).packed, None
+    if rtype in (CNAME_TYPE, NS_TYPE, PTR_TYPE):
+        target = _absolute_name(tokens[0], origin)
+        return qname2bytes(target), target
+    if rtype == MX_TYPE:
+        return MX_PREFERENCE.pack(int(tokens[0])) + qname2bytes(_absolute_name(tokens[1], origin)), None
+    if rtype == TXT_TYPE:
+        strings = [_unquote(token).encode() for token in tokens]
+        if any(len(string) > 255 for string in strings):
+            raise ZoneException('TXT string is longer than 255 bytes')
+        return b''.join(bytes([len(string)]) + string for string in strings), None
+    mname, rname = _absolute_name(tokens[0], origin), _absolute_name(tokens[1], origin)
+    return qname2bytes(mname) + qname2bytes(rname) + SOA_NUMBERS.pack(*(int(t) for t in tokens[2:7])), None
+
+
+def _absolute_name(name: str, origin: str) -> str:
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return sys.intern(name.rstrip('.').lower())
+    return sys.intern(f'{name}.{origin}'.lower() if origin else name.lower())
+
+
+def _unquote(token: str) -> str:
+    if token.startswith('"') and token.endswith('"'):
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    return token
+
+
+def _node(root: _ZoneNode, name: str) -> _ZoneNode:
+    node = root
+    for label in reversed(name.split('.')) if name else []:
+        node = node.children.setdefault(label, _ZoneNode())
+    return node
+
+
+class ZoneException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -0,0 +1,147 @@
+import argparse
+import ipaddress
+import random
+import socket
+import struct
+from threading import Thread, Timer
+
+from dns_models import DnsHeader, DnsPackage, DnsResourceRecord, SOA_TYPE, NXDOMAIN, truncated_package
+from dns_parser import bytes2request
+from dns_tcp import frame, recv_message
+from dns_zone import ZoneSet
+
+A_TYPE = 1
+AAAA_TYPE = 28
+REFUSED = 5
+# mname, rname, serial, refresh, retry, expire, minimum
+SOA_RDATA = b'\x02ns\x04fake\x00\x0ahostmaster\x04fake\x00' + struct.pack('!5I', 1, 3600, 600, 86400, 60)
+
+
+# local stand-in for a forwarder: every A/AAAA query gets a synthetic address, names starting with "nx" get NXDOMAIN.
+# with zone files it is a stand-in for an authoritative server instead and answers only from them
+class FakeUpstream:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, delay: float = 0.0, loss: float = 0.0,
+                 ttl: int = 60, answers: int = 1, zones: list[str] = None):
+        self.zones = ZoneSet(zones, referrals=True)
+        self.zones.reload()
+        self.delay = delay
+        self.loss = loss
+        self.ttl = ttl
+        self.answers = answers
+        self.queries = 0
+        self.tcp_queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind(self.address)
+        self.active = False
+        self.demon = Thread(target=self.run, daemon=True)
+        self.tcp_demon = Thread(target=self.run_tcp, daemon=True)
+
+    def start(self):
+        self.active = True
+        self.tcp_sock.listen()
+        self.demon.start()
+        self.tcp_demon.start()
+        return self
+
+    def stop(self):
+        self.active = False
+        self.sock.close()
+        self.tcp_sock.close()
+
+    def run(self):
+        while self.active:
+            try:
+                request_bytes, address = self.sock.recvfrom(65535)
+            except OSError:
+                break
+            self.queries += 1
+            if random.random() < self.loss:
+                continue
+            if self.delay > 0:
+                Timer(self.delay, self.reply, (request_bytes, address)).start()
+            else:
+                self.reply(request_bytes, address)
+
+    def reply(self, request_bytes: bytes, address: tuple[str, int]):
+        try:
+            request = bytes2request(request_bytes)
+            response_bytes = self.answer(request_bytes)
+            if len(response_bytes) > request.udp_payload_size():
+                response_bytes = truncated_package(response_bytes, request.queries)
+            self.sock.sendto(response_bytes, address)
+        except Exception:
+            pass
+
+    def run_tcp(self):
+        while self.active:
+            try:
+                connection, _ = self.tcp_sock.accept()
+            except OSError:
+                break
+            Thread(target=self.serve_tcp, args=(connection,), daemon=True).start()
+
+    def serve_tcp(self, connection: socket.socket):
+        with connection:
+            while self.active:
+                try:
+                    request_bytes = recv_message(connection)
+                except OSError:
+                    break
+                self.tcp_queries += 1
+                connection.sendall(frame(self.answer(request_bytes)))
+
+    def answer(self, request_bytes: bytes) -> bytes:
+        request = bytes2request(request_bytes)
+        package = DnsPackage(DnsHeader(request.header.id, aa=False, rd=request.header.rd))
+        package.with_queries(request.queries)
+        if len(self.zones.filenames) > 0:
+            response_bytes = self.zones.answer(request)
+            if response_bytes == b'':
+                package.header.rcode = REFUSED
+                return package.to_bytes()
+            return response_bytes
+        query = request.queries[0]
+        if query.qname.startswith('nx'):
+            package.header.rcode = NXDOMAIN
+            zone = query.qname.partition('.')[2] or query.qname
+            return package.with_auth_records(
+                [DnsResourceRecord(zone, SOA_TYPE, 1, self.ttl, len(SOA_RDATA), SOA_RDATA)]).to_bytes()
+
+        # the address is derived from the name, so repeated answers are stable
+        seed = int.from_bytes(query.qname.encode()[-16:].rjust(16, b'\0'), 'big')
+        if query.qtype == A_TYPE:
+            addresses = [ipaddress.IPv4Address(0x0A000000 | seed + i & 0xFFFFFF) for i in range(self.answers)]
+        elif query.qtype == AAAA_TYPE:
+            addresses = [ipaddress.IPv6Address(0xFD00 << 112 | seed + i & (1 << 112) - 1) for i in range(self.answers)]
+        else:
+            return package.to_bytes()
+        return package.with_ans_records(
+            [DnsResourceRecord(query.qname, query.qtype, query.qclass, self.ttl, len(a.packed), a.packed)
+             for a in addresses]).to_bytes()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Тестовый вышестоящий DNS сервер')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5353)
+    parser.add_argument('-d', '--delay', type=float, default=0.0, help='Задержка ответа в секундах')
+    parser.add_argument('-l', '--loss', type=float, default=0.0, help='Доля запросов, оставленных без ответа')
+    parser.add_argument('--ttl', type=int, default=60)
+    parser.add_argument('-a', '--answers', type=int, default=1, help='Количество адресов в ответе')
+    parser.add_argument('-z', '--zone', type=str, nargs='*', default=[],
+                        help='Файлы зон: сервер отвечает только из них, как авторитетный, и отдаёт делегирования')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    upstream = FakeUpstream(args.host, args.port, args.delay, args.loss, args.ttl, args.answers,
+                            args.zone).start()
+    print(f'Тестовый сервер запущен на {upstream.address[0]}:{upstream.address[1]}')
+    while input() != 'stop':
+        pass
+    upstream.stop()
@@ -1,20 +1,102 @@
 import argparse
 
-from dns_cache import DnsCacheController
-from dns_server import DnsCacheServer
+from dns_async_server import AsyncDnsCacheServer
+from dns_cache import DnsCacheController, STALE_WINDOW, LOAD_WAIT_TIMEOUT, REFRESH_FRACTION, REFRESH_HITS
+from dns_hot_names import HOT_NAMES
+from dns_metrics import TelemetryOptions
+from dns_models import EDNS_PAYLOAD_SIZE
+from dns_ratelimit import RateLimitOptions, POLICIES, SLIP, DEFAULT_PREFIX
+from dns_resolver import ResolverOptions
+from dns_server import DnsCacheServer, WARM_UP_PARALLELISM
+from dns_workers import DnsWorkerPool
+
+ENGINES = {'thread': DnsCacheServer, 'asyncio': AsyncDnsCacheServer}
 
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--forwarder', type=str, default='8.8.8.8')
+    parser.add_argument('-f', '--forwarder', type=str, nargs='+', default=['8.8.8.8'],
+                        help='Вышестоящие DNS серверы в формате host[:port]; '
+                             'если сервер отвечает медленно, запрос дублируется следующему')
     parser.add_argument('-p', '--port', type=int, default=53)
+    parser.add_argument('-e', '--engine', choices=ENGINES.keys(), default='thread',
+                        help='Способ обработки запросов: последовательный цикл или asyncio')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Количество процессов, слушающих порт через SO_REUSEPORT; их кеши сохраняются '
+                             'только при остановке командой stop, без промежуточных контрольных точек')
+    parser.add_argument('-m', '--cache-memory', type=int, default=256,
+                        help='Ограничение памяти под кеш в мегабайтах (0 - без ограничения)')
+    parser.add_argument('--stale-window', type=int, default=STALE_WINDOW,
+                        help='Сколько секунд после истечения TTL отдавать записи, если вышестоящий сервер недоступен')
+    parser.add_argument('--refresh-fraction', type=float, default=REFRESH_FRACTION,
+                        help='Доля TTL до истечения, в которую популярная запись запрашивается заново заранее')
+    parser.add_argument('--refresh-hits', type=int, default=REFRESH_HITS,
+                        help='Сколько обращений к записи делают её популярной для заблаговременного обновления')
+    parser.add_argument('--edns-size', type=int, default=EDNS_PAYLOAD_SIZE,
+                        help='Максимальный размер UDP ответа для клиентов с EDNS0, больший ответ отправляется по TCP')
+    parser.add_argument('-z', '--zone', type=str, nargs='*', default=[],
+                        help='Файлы локальных зон (формат RFC 1035), на имена из которых сервер отвечает сам. '
+                             'Команда reload перечитывает их без перезапуска')
+    parser.add_argument('--hot-names', type=int, default=HOT_NAMES,
+                        help='Сколько самых популярных имён сохранять рядом с кешем для прогрева при запуске')
+    parser.add_argument('--warm-up', type=int, default=WARM_UP_PARALLELISM,
+                        help='Сколько популярных имён запрашивать одновременно при прогреве кеша (0 - без прогрева)')
+    parser.add_argument('-i', '--iterative', action='store_true',
+                        help='Разрешать имена самостоятельно, начиная с корневых серверов, вместо обращения к -f')
+    parser.add_argument('--root-hints', type=str, nargs='+', default=None,
+                        help='Адреса корневых серверов в формате host[:port] для итеративного режима')
+    parser.add_argument('--ns-port', type=int, default=53,
+                        help='Порт авторитетных серверов в итеративном режиме (для тестовых стендов)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Запросов в секунду по UDP с одной подсети клиентов (0 - без ограничения); '
+                             'с -w ограничение и запас делятся поровну между обработчиками')
+    parser.add_argument('--rate-burst', type=float, default=None,
+                        help='Сколько запросов подряд подсеть может отправить сверх ограничения (по умолчанию - '
+                             'секундный запас)')
+    parser.add_argument('--rate-prefix', type=int, default=DEFAULT_PREFIX,
+                        help='Длина префикса IPv4, по которому клиенты объединяются в подсеть')
+    parser.add_argument('--rate-policy', choices=POLICIES, default=SLIP,
+                        help='Что делать с запросами сверх ограничения: slip - короткий ответ с TC=1, '
+                             'клиент повторит запрос по TCP; drop - не отвечать')
+    parser.add_argument('--log-sample', type=float, default=0.0,
+                        help='Доля запросов, попадающих в журнал (0 - журнал выключен, 1 - все запросы)')
+    parser.add_argument('--log-file', type=str, default=None, help='Файл журнала запросов вместо вывода в консоль')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Порт на 127.0.0.1, по которому метрики отдаются в текстовом формате Prometheus')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Файл, в который периодически пишутся метрики')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     try:
         args = get_args()
-        with DnsCacheController() as controller:
-            DnsCacheServer('127.0.0.1', 53, controller.cache, args.forwarder, args.port).start()
+        telemetry = TelemetryOptions(args.log_sample, args.log_file, args.metrics_port, args.metrics_file)
+        iterative = ResolverOptions(args.root_hints, args.ns_port) if args.iterative else None
+        rate_limit = RateLimitOptions(args.rate_limit, args.rate_burst, args.rate_prefix, args.rate_policy) \
+            if args.rate_limit > 0 else None
+        with DnsCacheController(max_memory=args.cache_memory * 2 ** 20 or None, stale_window=args.stale_window,
+                                hot_names=args.hot_names, checkpoints=args.workers <= 1,
+                                refresh_fraction=args.refresh_fraction, refresh_hits=args.refresh_hits) as controller:
+            if args.workers > 1:
+                # every worker gets a copy of the cache when it starts, so the snapshot has to be loaded first
+                controller.loaded.wait(LOAD_WAIT_TIMEOUT)
+                DnsWorkerPool(ENGINES[args.engine], args.workers, '127.0.0.1', 53,
+                              controller.cache, args.forwarder, args.port, args.edns_size, telemetry,
+                              args.zone, iterative, rate_limit, controller.hot_names,
+                              controller.warm_up_keys, args.warm_up).start()
+            else:
+                server = ENGINES[args.engine]('127.0.0.1', 53, controller.cache, args.forwarder, args.port,
+                                              args.edns_size)
+                exporter = telemetry.attach(server)
+                server.hot_names = controller.hot_names
+                if len(args.zone) > 0:
+                    server.use_zones(args.zone)
+                if iterative is not None:
+                    server.use_resolver(iterative.root_hints, iterative.ns_port)
+                if rate_limit is not None:
+                    server.use_rate_limit(rate_limit.rate, rate_limit.burst, rate_limit.prefix, rate_limit.policy)
+                server.start_warm_up(controller.warm_up_keys, args.warm_up, controller.loaded)
+                server.start()
+                exporter.stop()
     except:
         print('Что-то пошло не так. Попробуйте запустить от имени администратора')
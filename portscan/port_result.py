@@ -5,16 +5,26 @@ class PortResult:
         self.host = host
         self.port = port
         self.is_open = is_open
+        # no answer at all, something between drops the probes
+        self.is_filtered = False
         self.type = ""
         self.description = ""
 
     def set_open(self):
         self.is_open = True
+        self.is_filtered = False
         return self
 
     def set_close(self):
         self.is_open = False
+        self.is_filtered = False
+        return self
+
+    def set_filtered(self):
+        self.is_open = False
+        self.is_filtered = True
         return self
 
     def to_string(self):
-        return f'{"" if self.is_open else "close"} {self.port}/{self.type}: {self.description}'
+        state = "" if self.is_open else "filtered" if self.is_filtered else "close"
+        return f'{state} {self.port}/{self.type}: {self.description}'
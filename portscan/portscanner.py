@@ -1,67 +1,144 @@
 import argparse
-import socket
+import asyncio
+import os
+import sys
 from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore
 
+import syn_scanner
+import tcp_async_scanner
 import tcp_scanner
 import udp_scanner
 from port_result import PortResult
+from targets import Targets, TargetException, parse_hosts, parse_ports
 from utils import recognise_port, RESULTS, GREEN, DEFAULT, start_printer
 
+# targets queued in the thread pool per thread
+PENDING_PER_THREAD = 4
 
-def scan_port_and_save_if_open(ip: str, port: int, out: list[PortResult], scanner):
-    result = scanner.scan_port(ip, port)
+
+def save_if_open(result: PortResult, out: list[PortResult], show_host: bool):
     if result.is_open:
         out.append(recognise_port(result))
-        RESULTS.append(GREEN + result.to_string() + DEFAULT)
+        text = f'{result.host} {result.to_string().lstrip()}' if show_host else result.to_string()
+        RESULTS.append(GREEN + text + DEFAULT)
 
 
-def find_open_ports(ip: str, port_from: int, port_to_including: int, scanner) -> list[PortResult]:
-    pool = ThreadPool()
+def find_open_ports(targets: Targets, scanner) -> list[PortResult]:
+    threads = os.cpu_count() or 1
+    pool = ThreadPool(threads)
     ports = []
-    for port in range(port_from, port_to_including + 1):
-        pool.apply_async(scan_port_and_save_if_open, args=(ip, port, ports, scanner))
+    # the pool would take every target into its queue at once, only a few of them wait there at a time
+    slots = BoundedSemaphore(PENDING_PER_THREAD * threads)
+
+    def scanned(result: PortResult | None):
+        try:
+            if result is not None:
+                save_if_open(result, ports, targets.host_count > 1)
+        finally:
+            slots.release()
+
+    for ip, port in targets:
+        slots.acquire()
+        pool.apply_async(scanner.scan_port, args=(ip, port), callback=scanned,
+                         error_callback=lambda _: slots.release())
 
     pool.close()
     pool.join()
     return ports
 
 
-def main(host: str, port_from: int, port_to: int, tcp: bool, udp: bool):
+def find_open_ports_async(targets: Targets, concurrency: int, rate: float, timeout: float) -> list[PortResult]:
+    return asyncio.run(collect_open_ports(targets, concurrency, rate, timeout))
+
+
+async def collect_open_ports(targets: Targets, concurrency: int, rate: float, timeout: float) -> list[PortResult]:
+    ports = []
+    async for result in tcp_async_scanner.scan(targets, concurrency, rate, timeout):
+        save_if_open(result, ports, targets.host_count > 1)
+    return ports
+
+
+def find_open_ports_syn(targets: Targets, rate: float, retries: int, wait: float) -> list[PortResult]:
+    ports = []
+    for result in syn_scanner.SynScanner(rate, retries, wait).scan(targets):
+        save_if_open(result, ports, targets.host_count > 1)
+    return ports
+
+
+def legacy_ports(argv: list[str]) -> list[str]:
+    # "-p 1 1024" of the earlier versions is still the range 1-1024, any other spec is a single argument
+    for i, arg in enumerate(argv[:-2]):
+        if arg in ("-p", "--ports") and argv[i + 1].isdigit() and argv[i + 2].isdigit():
+            return argv[:i + 1] + [f"{argv[i + 1]}-{argv[i + 2]}"] + argv[i + 3:]
+    return argv
+
+
+def main(hosts: list[str], ports: str, tcp: bool, udp: bool, engine: str = 'asyncio',
+         concurrency: int = tcp_async_scanner.DEFAULT_CONCURRENCY, rate: float = 0,
+         timeout: float = tcp_async_scanner.DEFAULT_TIMEOUT, retries: int = syn_scanner.DEFAULT_RETRIES,
+         seed: int | None = None):
     try:
-        ip = socket.gethostbyname(host)
-    except socket.error:
-        print("\033[31m" + f"Введённый хост \"{host}\" не найден. Проверьте корректность и повторите попытку"
-              + "\033[0m")
+        targets = Targets(parse_hosts(hosts), parse_ports(ports), seed)
+    except TargetException as e:
+        print("\033[31m" + f"{e.msg}. Проверьте корректность и повторите попытку" + "\033[0m")
         return
 
     if not tcp and not udp:
         print("Не указан тип сканирования. Используйте --help для подробностей")
         return
 
-    print("\033[36m" + f"\nЗапуск сканирования {host} [{ip}]" + "\033[0m")
+    if tcp and engine == 'syn' and hasattr(os, 'geteuid') and os.geteuid() != 0:
+        print("\033[31m" + "SYN сканирование использует raw сокеты, запустите сканер от root" + "\033[0m")
+        return
+
+    print("\033[36m" + f"\nЗапуск сканирования {' '.join(hosts)}: "
+                       f"{targets.host_count} хостов, {targets.port_count} портов" + "\033[0m")
     start_printer()
 
     if tcp:
-        print("\033[36m" + f"\ntcp сканирование запущено c {port_from} по {port_to} порты" + "\033[0m")
+        print("\033[36m" + f"\ntcp сканирование запущено по портам {ports}" + "\033[0m")
         print("\tСканирование может занять некоторое время, пожалуйста, ожидайте завершения")
-        find_open_ports(ip, port_from, port_to, tcp_scanner)
+        if engine == 'asyncio':
+            find_open_ports_async(targets, concurrency, rate, timeout)
+        elif engine == 'syn':
+            find_open_ports_syn(targets, rate, retries, timeout)
+        else:
+            find_open_ports(targets, tcp_scanner)
 
     if udp:
-        print("\033[36m" + f"\nudp сканирование запущено c {port_from} по {port_to} порты" + "\033[0m")
+        print("\033[36m" + f"\nudp сканирование запущено по портам {ports}" + "\033[0m")
         print("\tСканирование может занять некоторое время, пожалуйста, ожидайте завершения")
-        find_open_ports(ip, port_from, port_to, udp_scanner)
+        find_open_ports(targets, udp_scanner)
 
     print("\033[36m" + "\nСканирование завершено" + "\033[0m")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("host", help="IP адрес или host, у которого необходимо просканировать порты", type=str)
+    parser.add_argument("hosts", nargs="+", type=str,
+                        help="IP адреса, host или сети CIDR (10.0.0.0/24), у которых необходимо просканировать порты; "
+                             "можно перечислить через запятую")
     parser.add_argument("-t", help="TCP сканирование", action="store_true", default=False)
     parser.add_argument("-u", help="UDP сканирование", action="store_true", default=False)
-    parser.add_argument("-p", "--ports", help="Диапазон портов сканирования (включительно)", type=int,
-                        default=[1, 1024], nargs=2)
-
-    args = parser.parse_args()
-
-    main(args.host, args.ports[0], args.ports[1], args.t, args.u)
+    parser.add_argument("-p", "--ports", type=str, default="1-1024",
+                        help="Порты сканирования: диапазон (1-1024) или список (22,80,8000-8100); "
+                             "два числа через пробел (-p 1 1024) по-прежнему задают диапазон")
+    parser.add_argument("-e", "--engine", choices=["asyncio", "threads", "syn"], default="asyncio",
+                        help="Способ TCP сканирования: тысячи неблокирующих подключений в asyncio, "
+                             "блокирующие подключения в пуле потоков или SYN пакеты через raw сокеты (нужен root)")
+    parser.add_argument("-c", "--concurrency", type=int, default=tcp_async_scanner.DEFAULT_CONCURRENCY,
+                        help="Сколько подключений asyncio держит одновременно")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="Сколько подключений в секунду начинать (0 - без ограничения)")
+    parser.add_argument("--timeout", type=float, default=tcp_async_scanner.DEFAULT_TIMEOUT,
+                        help="Сколько секунд ждать ответа порта в asyncio и SYN сканировании")
+    parser.add_argument("--retries", type=int, default=syn_scanner.DEFAULT_RETRIES,
+                        help="Сколько раз повторить SYN без ответа, прежде чем считать порт фильтруемым")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Зерно случайного порядка проб, с одним зерном порядок повторяется")
+
+    args = parser.parse_args(legacy_ports(sys.argv[1:]))
+
+    main(args.hosts, args.ports, args.t, args.u, args.engine, args.concurrency, args.rate,
+         args.timeout, args.retries, args.seed)
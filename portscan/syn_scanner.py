@@ -0,0 +1,172 @@
+import hashlib
+import os
+import queue
+import socket
+import struct
+import time
+from threading import Thread, Lock, Event
+from typing import Iterable, Iterator
+
+from port_result import PortResult
+
+# source port, destination port, sequence, acknowledgment, data offset, flags, window, checksum, urgent pointer
+TCP_HEADER = struct.Struct('!HHIIBBHHH')
+PSEUDO_HEADER = struct.Struct('!4s4sBBH')
+SYN = 0x02
+RST = 0x04
+ACK = 0x10
+WINDOW = 1024
+DEFAULT_RETRIES = 1
+DEFAULT_WAIT = 1.0
+RECEIVE_TIMEOUT = 0.1
+# the raw receiver gets every tcp packet of the host, replies of a fast scan must not be dropped in the queue;
+# as root the buffer may be larger than net.core.rmem_max
+RECEIVE_BUFFER = 16 * 2 ** 20
+PACING_GRANULARITY = 0.002
+# outgoing addresses remembered per target host, a sweep of a large network forgets them from time to time
+MAX_SOURCES = 4096
+
+
+def checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def source_ip(ip: str) -> str:
+    # the kernel picks the outgoing address for a connected udp socket, nothing is sent
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((ip, 9))
+        return sock.getsockname()[0]
+
+
+class SynScanner:
+    # half-open scan over raw sockets: a SYN is sent to every port and the first reply tells the state.
+    # SYN-ACK - open (the kernel answers it with RST, since no socket of ours waits for it), RST - closed,
+    # nothing after all retries - filtered. The sequence number of a probe is a keyed hash of its target,
+    # so a reply is matched to the probe by its acknowledgment number and stray packets are ignored
+    def __init__(self, rate: float = 0, retries: int = DEFAULT_RETRIES, wait: float = DEFAULT_WAIT):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.retries = retries
+        self.wait = wait
+        self.secret = os.urandom(16)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        self.receiver.settimeout(RECEIVE_TIMEOUT)
+        self.receiver.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_RCVBUFFORCE', socket.SO_RCVBUF), RECEIVE_BUFFER)
+        # the source port is held by a bound socket, so no real connection of this host gets it during the scan
+        self.port_holder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port_holder.bind(('0.0.0.0', 0))
+        self.port = self.port_holder.getsockname()[1]
+        self.sources: dict[str, bytes] = {}
+        self.locker = Lock()
+        # (ip, port) -> (sent at, probes sent), the oldest probe first
+        self.pending: dict[tuple[str, int], (float, int)] = {}
+        self.results: queue.Queue[PortResult | None] = queue.Queue()
+        self.stopped = Event()
+
+    def scan(self, targets: Iterable[tuple[str, int]]) -> Iterator[PortResult]:
+        sender = Thread(target=self.send_all, args=(targets,), daemon=True)
+        receiver = Thread(target=self.receive, daemon=True)
+        receiver.start()
+        sender.start()
+        try:
+            while (result := self.results.get()) is not None:
+                yield result
+        finally:
+            self.stopped.set()
+            receiver.join()
+            self.close()
+
+    def cookie(self, ip: str, port: int) -> int:
+        digest = hashlib.blake2b(f'{ip}:{port}'.encode(), digest_size=4, key=self.secret).digest()
+        return int.from_bytes(digest, 'big')
+
+    def probe(self, ip: str, port: int) -> bytes:
+        source = self.sources.get(ip)
+        if source is None:
+            if len(self.sources) >= MAX_SOURCES:
+                self.sources.clear()
+            source = self.sources.setdefault(ip, socket.inet_aton(source_ip(ip)))
+        header = TCP_HEADER.pack(self.port, port, self.cookie(ip, port), 0, 5 << 4, SYN, WINDOW, 0, 0)
+        pseudo_header = PSEUDO_HEADER.pack(source, socket.inet_aton(ip), 0, socket.IPPROTO_TCP, len(header))
+        return header[:16] + checksum(pseudo_header + header).to_bytes(2, 'big') + header[18:]
+
+    def send(self, target: tuple[str, int], probes: int):
+        with self.locker:
+            self.pending[target] = (time.monotonic(), probes)
+        try:
+            self.sender.sendto(self.probe(*target), (target[0], 0))
+        except OSError:
+            pass
+
+    def send_all(self, targets: Iterable[tuple[str, int]]):
+        try:
+            next_start = time.monotonic()
+            for target in targets:
+                if self.stopped.is_set():
+                    return
+                if self.interval > 0:
+                    delay = next_start - time.monotonic()
+                    if delay > PACING_GRANULARITY:
+                        time.sleep(delay)
+                    next_start = max(next_start, time.monotonic() - self.interval) + self.interval
+                self.send(target, 1)
+                self.resend_expired()
+            while len(self.pending) > 0 and not self.stopped.is_set():
+                time.sleep(RECEIVE_TIMEOUT)
+                self.resend_expired()
+        finally:
+            self.results.put(None)
+
+    def resend_expired(self):
+        # probes are kept in the order they were sent, the expired ones are always at the front
+        now = time.monotonic()
+        while True:
+            with self.locker:
+                if len(self.pending) == 0:
+                    return
+                target, (sent_at, probes) = next(iter(self.pending.items()))
+                if now - sent_at < self.wait:
+                    return
+                del self.pending[target]
+            if probes <= self.retries:
+                self.send(target, probes + 1)
+            else:
+                result = PortResult(*target)
+                result.type = 'tcp'
+                self.results.put(result.set_filtered())
+
+    def receive(self):
+        while not self.stopped.is_set():
+            try:
+                packet = self.receiver.recv(0xFFFF)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            ip_header_length = (packet[0] & 0x0F) * 4
+            if len(packet) < ip_header_length + TCP_HEADER.size:
+                continue
+            source_port, destination_port, _, acknowledgment, _, flags, _, _, _ = \
+                TCP_HEADER.unpack_from(packet, ip_header_length)
+            if destination_port != self.port or not flags & (ACK | RST):
+                continue
+            target = (socket.inet_ntoa(packet[12:16]), source_port)
+            # a SYN-ACK and a RST to a SYN both acknowledge the sequence number of the probe plus one
+            if acknowledgment != self.cookie(*target) + 1 & 0xFFFFFFFF:
+                continue
+            with self.locker:
+                if self.pending.pop(target, None) is None:
+                    continue
+            result = PortResult(*target)
+            result.type = 'tcp'
+            self.results.put(result.set_open() if flags & SYN else result.set_close())
+
+    def close(self):
+        self.sender.close()
+        self.receiver.close()
+        self.port_holder.close()
@@ -0,0 +1,149 @@
+import ipaddress
+import random
+import socket
+from bisect import bisect_right
+from typing import Iterator
+
+MAX_PORT = 65535
+# deterministic for every number below 3.3 * 10^24, far more than hosts * ports can be
+PRIME_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+
+def is_prime(n: int) -> bool:
+    if n < 2:
+        return False
+    for base in PRIME_BASES:
+        if n % base == 0:
+            return n == base
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for base in PRIME_BASES:
+        x = pow(base, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def safe_prime_above(n: int) -> int:
+    # p = 2q + 1 with a prime q: p - 1 has only the factors 2 and q, so a primitive root is checked with two powers
+    q = max((n + 1) // 2, 2)
+    while not (is_prime(q) and is_prime(2 * q + 1)):
+        q += 1
+    return 2 * q + 1
+
+
+def permutation(n: int, rng: random.Random = None) -> Iterator[int]:
+    # every number of 0..n-1 once, in a pseudo-random order and in constant memory:
+    # x -> x * g mod p with a primitive root g visits every element of 1..p-1, the ones above n are skipped
+    if n <= 0:
+        return
+    rng = rng or random.Random()
+    p = safe_prime_above(n)
+    q = (p - 1) // 2
+    while True:
+        g = rng.randint(2, p - 2)
+        if pow(g, 2, p) != 1 and pow(g, q, p) != 1:
+            break
+    x = start = rng.randint(1, p - 1)
+    while True:
+        if x <= n:
+            yield x - 1
+        x = x * g % p
+        if x == start:
+            return
+
+
+def parse_hosts(specs: list[str]) -> list[(int, int)]:
+    # "host", "10.0.0.1", "10.0.0.0/16", also comma separated; every item is a range (first address, count)
+    hosts = []
+    for item in ','.join(specs).split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        if '/' in item:
+            try:
+                network = ipaddress.IPv4Network(item, strict=False)
+            except ValueError:
+                raise TargetException(f'Некорректная сеть "{item}"')
+            hosts.append((int(network.network_address), network.num_addresses))
+            continue
+        try:
+            ip = socket.gethostbyname(item)
+        except socket.error as e:
+            raise TargetException(f'Введённый хост "{item}" не найден', e)
+        hosts.append((int(ipaddress.IPv4Address(ip)), 1))
+    if len(hosts) == 0:
+        raise TargetException('Не указано ни одного хоста')
+    return hosts
+
+
+def parse_ports(spec: str) -> list[(int, int)]:
+    # "80", "1-1024", "22,80,8000-8100"; every item is a range (first port, count)
+    ports = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        first, _, last = item.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise TargetException(f'Некорректные порты "{item}"')
+        if not 0 < first <= last <= MAX_PORT:
+            raise TargetException(f'Порты "{item}" вне диапазона 1-{MAX_PORT}')
+        ports.append((first, last - first + 1))
+    if len(ports) == 0:
+        raise TargetException('Не указано ни одного порта')
+    return ports
+
+
+class Targets:
+    # host x port space of the ranges without expanding them: an index is turned into (ip, port) on the fly.
+    # neighbour indices are different hosts, and the order of indices is a random permutation of the whole space,
+    # so no host gets a burst of probes and a /16 sweep takes as much memory as one host
+    def __init__(self, hosts: list[(int, int)], ports: list[(int, int)], seed: int | None = None):
+        self.hosts = hosts
+        self.ports = ports
+        self.seed = seed
+        self.host_offsets = self.offsets(hosts)
+        self.port_offsets = self.offsets(ports)
+        self.host_count = self.host_offsets[-1]
+        self.port_count = self.port_offsets[-1]
+
+    @staticmethod
+    def offsets(ranges: list[(int, int)]) -> list[int]:
+        offsets = [0]
+        for _, count in ranges:
+            offsets.append(offsets[-1] + count)
+        return offsets
+
+    @staticmethod
+    def pick(ranges: list[(int, int)], offsets: list[int], index: int) -> int:
+        i = bisect_right(offsets, index) - 1
+        return ranges[i][0] + index - offsets[i]
+
+    def __getitem__(self, index: int) -> (str, int):
+        host_index, port_index = index % self.host_count, index // self.host_count
+        ip = self.pick(self.hosts, self.host_offsets, host_index)
+        return socket.inet_ntoa(ip.to_bytes(4, 'big')), self.pick(self.ports, self.port_offsets, port_index)
+
+    def __len__(self):
+        return self.host_count * self.port_count
+
+    def __iter__(self) -> Iterator[tuple[str, int]]:
+        for index in permutation(len(self), random.Random(self.seed)):
+            yield self[index]
+
+
+class TargetException(Exception):
+    def __init__(self, msg: str = None, inner_exception: Exception = None):
+        self.msg = msg
+        self.inner_exception = inner_exception
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Iterable, AsyncIterator
+
+from port_result import PortResult
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_CONCURRENCY = 1000
+DEFAULT_TIMEOUT = 1.0
+# descriptors left for everything else of the process
+RESERVED_DESCRIPTORS = 64
+# pauses shorter than this are not slept, the next connects go out at once and the average rate stays the same
+PACING_GRANULARITY = 0.002
+
+
+def max_concurrency(concurrency: int) -> int:
+    # every connect in flight holds a socket, more of them than the descriptor limit only fail with EMFILE
+    if resource is None:
+        return concurrency
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, soft_limit - RESERVED_DESCRIPTORS))
+
+
+async def scan_port(ip: str, port: int, timeout: float = DEFAULT_TIMEOUT) -> PortResult:
+    result = PortResult(ip, port)
+    result.type = "tcp"
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return result.set_close()
+    writer.close()
+    return result.set_open()
+
+
+async def scan(targets: Iterable[tuple[str, int]], concurrency: int = DEFAULT_CONCURRENCY, rate: float = 0,
+               timeout: float = DEFAULT_TIMEOUT) -> AsyncIterator[PortResult]:
+    # targets are taken lazily, at most `concurrency` connects are in flight and at most `rate` are started
+    # per second (0 - no limit); results come out in the order they are known, not in the order of targets
+    loop = asyncio.get_running_loop()
+    interval = 1 / rate if rate > 0 else 0
+    concurrency = max_concurrency(concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue[PortResult | None] = asyncio.Queue()
+    probes: set[asyncio.Task] = set()
+
+    async def probe(ip: str, port: int):
+        try:
+            results.put_nowait(await scan_port(ip, port, timeout))
+        finally:
+            slots.release()
+
+    async def feed():
+        try:
+            next_start = loop.time()
+            for ip, port in targets:
+                await slots.acquire()
+                if interval > 0:
+                    delay = next_start - loop.time()
+                    if delay > PACING_GRANULARITY:
+                        await asyncio.sleep(delay)
+                    next_start = max(next_start, loop.time() - interval) + interval
+                task = loop.create_task(probe(ip, port))
+                probes.add(task)
+                task.add_done_callback(probes.discard)
+            # every slot is back only when the last probe is finished
+            for _ in range(concurrency):
+                await slots.acquire()
+        finally:
+            results.put_nowait(None)
+
+    feeder = loop.create_task(feed())
+    try:
+        while (result := await results.get()) is not None:
+            yield result
+        # an error of the targets iterator comes out here
+        await feeder
+    finally:
+        feeder.cancel()
+        for task in list(probes):
+            task.cancel()